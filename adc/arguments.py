@@ -1,6 +1,6 @@
 import base64
-
-from IPy import IP
+import socket
+import re
 
 class List:
     """
@@ -15,71 +15,140 @@ IP6 = "IP6";
 B32 = "B32";
 STR = "STR";
 
-class Base32:
+class Base32(object):
     """
     A read only type to indicate that the containing message should be encoded using Base32
     """
     def __init__(self, val, size=None):
         self._val = val;
         self._size = size;
-    
+
     val = property(lambda self: self._val);
     size = property(lambda self: self._size);
-    
+
     def __str__(self):
         return self.val;
-    
+
     def __repr__(self):
         return "<Base32 val=" + repr(self.val) + ">"
 
+class IP(object):
+    """
+    A read only IPv4 or IPv6 address, stored packed in network byte order.
+    """
+    __slots__ = ('_packed', '_version');
+
+    FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6};
+
+    def __init__(self, val, ipversion=4):
+        # an already decoded address is copied, as IPy does.
+        if isinstance(val, IP):
+            self._packed = val._packed;
+            self._version = val._version;
+            return;
+
+        if ipversion not in self.FAMILIES:
+            raise ValueError("invalid ip version: " + repr(ipversion));
+
+        try:
+            self._packed = socket.inet_pton(self.FAMILIES[ipversion], val);
+        except (socket.error, TypeError), e:
+            raise ValueError("invalid IPv" + str(ipversion) + " address: " + repr(val));
+
+        self._version = ipversion;
+
+    packed = property(lambda self: self._packed);
+
+    def version(self):
+        return self._version;
+
+    def __int__(self):
+        return int(self._packed.encode("hex"), 16);
+
+    def __str__(self):
+        return socket.inet_ntop(self.FAMILIES[self._version], self._packed);
+
+    def __repr__(self):
+        return "IP(" + repr(str(self)) + ", ipversion=" + str(self._version) + ")";
+
+    def __eq__(self, o):
+        return isinstance(o, IP) and self._version == o._version and self._packed == o._packed;
+
+    def __ne__(self, o):
+        return not self.__eq__(o);
+
+    def __hash__(self):
+        return hash((self._version, self._packed));
+
+_escape_characters = re.compile(r"[ \n\\]");
+_escapes = {' ': "\\s", '\n': "\\n", '\\': "\\\\"};
+
+def _encode_string(v):
+    if _escape_characters.search(v) is None:
+        return v;
+    return _escape_characters.sub(lambda m: _escapes[m.group(0)], v);
+
+def _encode_base32(v):
+    return base64.b32encode(v.val).rstrip('=');
+
+"""
+Encoders by value type, see encode.
+"""
+ENCODERS = {
+    type(None): lambda v: "",
+    int: str,
+    long: str,
+    float: str,
+    str: _encode_string,
+    unicode: _encode_string,
+    IP: str,
+    Base32: _encode_base32,
+};
+
 def encode(v):
     """
     Encode a value, key to a specific type, always must return string or throw exception.
     """
-    if v is None:
-        return "";
-    
-    if type(v) in [int, long, float]:
-        return str(v);
+    encoder = ENCODERS.get(type(v), None);
+
+    if encoder is not None:
+        return encoder(v);
+
+    if isinstance(v, basestring):
+        return _encode_string(v);
     elif isinstance(v, IP):
-        if v.version() == 4:
-            return str(v)
-        elif v.version() == 6:
-            return str(v)
-    elif isinstance(v, basestring):
-        return v.replace(' ', "\\s").replace('\n', "\\n");
+        return str(v);
     elif isinstance(v, Base32):
-        enc = base64.b32encode(v.val);
-        o = enc.find('=');
-        if o == -1:
-            o = len(enc);
-        return enc[:o];
-    
+        return _encode_base32(v);
+
     raise ValueError("cannot encode value: " + str(type(v)) + " " + repr(v));
 
+def _decode_base32(v, *args):
+    if len(args) <= 0:
+        raise ValueError("decoding of type B32 requires extra argument: <size>");
+
+    size = args[0];
+    # pad to the length of the padded encoding of size bytes.
+    return Base32(base64.b32decode(v + "=" * ((size + 4) // 5 * 8 - len(v)), True));
+
+"""
+Decoders by type tag, see decode.
+"""
+DECODERS = {
+    STR: lambda v, *args: v,
+    INT: lambda v, *args: int(v),
+    B32: _decode_base32,
+    IP4: lambda v, *args: IP(v, 4),
+    IP6: lambda v, *args: IP(v, 6),
+};
+
 def decode(v, t, *args):
   if v is None:
     return None;
 
-  if t == STR:
-    return v;
-  elif t == INT:
-    return int(v);
-  elif t == B32:
-    if len(args) <= 0:
-      raise ValueError("decoding of type B32 requires extra argument: <size>");
-    
-    size = args[0];
-    
-    mod = size % 5;
-    
-    if mod == 0:
-        need = 0;
-    else:
-        need = (size + (5 - mod)) / 5 * 8 - len(v);
-    
-    return Base32(base64.b32decode(v + "=" * need, size));
-  elif t == IP4:
-    return IP(v, ipversion=4);
-  elif t == IP6:
-    return IP(v, ipversion=6);
+  decoder = DECODERS.get(t, None);
+
+  if decoder is None:
+    raise ValueError("cannot decode type: " + repr(t));
+
+  return decoder(v, *args);
@@ -0,0 +1,259 @@
+"""
+Conformance and throughput benchmark for the frame parsers in adc.parser.
+
+Generates a corpus of realistic frames for every header family, checks that
+all parser backends produce the same messages as the pyparsing reference and
+reports frames/s, microseconds/frame and allocations/frame for each of them,
+followed by the import time of the package modules.
+Allocations are counted as the garbage collected objects which are retained
+per frame, which is what matters when frames are buffered.
+
+Run with:
+
+    #> python -m adc.benchmark [frames-per-family] [seed]
+"""
+
+from . import parser
+from .message import Message, LazyMessage
+
+import gc
+import sys
+import random
+import timeit
+
+REFERENCE = "pyparsing";
+
+FAMILIES = ["B", "CIH", "DE", "F", "U"];
+
+_base32_character = parser.base32_character
+_text_character = parser.simple_alphanum + "abcdefghijklmnopqrstuvwxyz.,:;!?" + "   \n\\"
+
+def _sid(rnd):
+  return ''.join(rnd.choice(_base32_character) for i in range(4));
+
+def _cid(rnd):
+  return ''.join(rnd.choice(_base32_character) for i in range(39));
+
+def _escape(s):
+  return s.replace("\\", "\\\\").replace(" ", "\\s").replace("\n", "\\n");
+
+def _text(rnd, size):
+  """
+  Escaped free text, heavy on spaces, newlines and backslashes.
+  """
+  return _escape(''.join(rnd.choice(_text_character) for i in range(size)));
+
+def _binf(rnd, description_size):
+  fields = [
+    "ID" + _cid(rnd),
+    "PD" + _cid(rnd),
+    "NI" + _text(rnd, 12),
+    "SL" + str(rnd.randint(0, 20)),
+    "SS" + str(rnd.randint(0, 1024 ** 5)),
+    "SF" + str(rnd.randint(0, 100000)),
+    "HN" + str(rnd.randint(0, 50)),
+    "HR" + str(rnd.randint(0, 5)),
+    "HO" + str(rnd.randint(0, 5)),
+    "VEUC\\sV:0.83",
+    "SUTCP4,UDP4,ADC0,KEY0",
+    "US65536",
+    "U4" + str(rnd.randint(1024, 65535)),
+    "I4" + '.'.join(str(rnd.randint(0, 255)) for i in range(4)),
+    "DE" + _text(rnd, description_size),
+  ];
+  return "BINF " + _sid(rnd) + " " + " ".join(fields);
+
+def generate(family, count, seed=0):
+  """
+  Generate a list of count frames for the given header family.
+  """
+  rnd = random.Random(seed);
+  frames = list();
+
+  for i in range(count):
+    if family == "B":
+      choice = i % 3;
+      if choice == 0:   frames.append(_binf(rnd, 32));
+      elif choice == 1: frames.append(_binf(rnd, 4096));
+      else:             frames.append("BMSG " + _sid(rnd) + " " + _text(rnd, 80));
+    elif family == "CIH":
+      choice = i % 3;
+      if choice == 0:   frames.append("CINF ID" + _cid(rnd) + " NI" + _text(rnd, 12) + " DE" + _text(rnd, 64));
+      elif choice == 1: frames.append("ISTA 000 " + _text(rnd, 40));
+      else:             frames.append("HSUP ADBASE ADTIGR ADZLIB");
+    elif family == "DE":
+      if i % 2 == 0:    frames.append("DCTM " + _sid(rnd) + " " + _sid(rnd) + " ADC/1.0 " + str(rnd.randint(1024, 65535)) + " " + _text(rnd, 8));
+      else:             frames.append("EMSG " + _sid(rnd) + " " + _sid(rnd) + " " + _text(rnd, 120) + " PM" + _sid(rnd));
+    elif family == "F":
+      frames.append("FSCH " + _sid(rnd) + " +TCP4 -NAT0 AN" + _text(rnd, 10) + " AN" + _text(rnd, 6) + " TO" + str(rnd.randint(0, 1 << 31)));
+    elif family == "U":
+      frames.append("URES " + _cid(rnd) + " FN" + _text(rnd, 60) + " SI" + str(rnd.randint(0, 1 << 40)) + " SL" + str(rnd.randint(0, 20)));
+    else:
+      raise ValueError("no such header family: " + repr(family));
+
+  return frames;
+
+def canonical(message):
+  """
+  A backend independent representation of a parsed message, used to compare trees.
+  """
+  header = message.header;
+
+  if header is None:
+    return (None, list(message.params));
+
+  attrs = tuple(getattr(header, a, None) for a in ("type", "cmd", "my_sid", "target_sid", "my_cid", "add", "rem"));
+  return (header.__class__, attrs, list(message.params));
+
+def _message_parser(backend):
+  if backend == "lazy":
+    return LazyMessage.parse;
+  return lambda s: Message.parse(s, backend);
+
+def conformance(frames, backends=None):
+  """
+  Parse every frame with every backend and return a list of
+  (backend, frame, expected, actual) for each difference from the reference.
+
+  The pseudo backend "lazy" checks LazyMessage.parse.
+  """
+  if backends is None:
+    backends = parser.PARSERS.keys() + ["lazy"];
+
+  mismatches = list();
+
+  for frame in frames:
+    try:
+      expected = canonical(Message.parse(frame, REFERENCE));
+    except Exception, e:
+      expected = None;
+
+    for backend in backends:
+      if backend == REFERENCE:
+        continue;
+
+      try:
+        actual = canonical(_message_parser(backend)(frame));
+      except Exception, e:
+        actual = None;
+
+      if actual != expected:
+        mismatches.append((backend, frame, expected, actual));
+
+  return mismatches;
+
+def allocations(f, frames):
+  """
+  Number of garbage collected objects still alive per frame after applying f to every frame.
+  """
+  gc.collect();
+  gc.disable();
+
+  try:
+    before = len(gc.get_objects());
+    results = [f(frame) for frame in frames];
+    after = len(gc.get_objects());
+  finally:
+    gc.enable();
+
+  # the list holding the results is not accounted for the frames.
+  return float(after - before - 1) / len(frames);
+
+def measure(f, frames, repeat=3):
+  """
+  Returns (frames/s, us/frame, allocations/frame) for the best of repeat runs.
+  """
+  best = None;
+
+  for i in range(repeat):
+    start = timeit.default_timer();
+
+    for frame in frames:
+      f(frame);
+
+    elapsed = timeit.default_timer() - start;
+
+    if best is None or elapsed < best:
+      best = elapsed;
+
+  return (len(frames) / best, best * 1000000.0 / len(frames), allocations(f, frames));
+
+"""
+Modules whose import time is tracked by startup.
+"""
+STARTUP_MODULES = ["adc.parser", "adc.message", "adc.arguments"];
+
+def startup(modules=None, repeat=3):
+  """
+  Import time in ms of each module in a fresh interpreter, minus the time of
+  starting an interpreter, together with the time of the first parsed frame.
+  """
+  import subprocess;
+
+  if modules is None:
+    modules = STARTUP_MODULES;
+
+  def _time(code):
+    best = None;
+
+    for i in range(repeat):
+      start = timeit.default_timer();
+      subprocess.check_call([sys.executable, "-c", code]);
+      elapsed = timeit.default_timer() - start;
+
+      if best is None or elapsed < best:
+        best = elapsed;
+
+    return best;
+
+  base = _time("pass");
+  result = [(m, (_time("import " + m) - base) * 1000.0) for m in modules];
+
+  for backend in sorted(parser.PARSERS.keys()):
+    code = "from adc.message import Message; Message.parse('BINF AAAA NIfoo', " + repr(backend) + ")";
+    result.append(("first " + backend + " frame", (_time(code) - base) * 1000.0));
+
+  return result;
+
+def _report(out, family, backend, name, result):
+  fps, us, allocs = result;
+  out.write("%-4s %-10s %-17s %10.0f frames/s %8.2f us/frame %8.1f objects/frame\n" % (family, backend, name, fps, us, allocs));
+
+def run(count=100, seed=0, out=sys.stdout):
+  failed = False;
+
+  for family in FAMILIES:
+    frames = generate(family, count, seed);
+
+    for backend, frame, expected, actual in conformance(frames):
+      failed = True;
+      out.write("MISMATCH " + backend + ": " + repr(frame) + "\n");
+      out.write("  expected: " + repr(expected) + "\n");
+      out.write("  actual:   " + repr(actual) + "\n");
+
+    for backend in sorted(parser.PARSERS.keys()):
+      parse = parser.getParser(backend);
+
+      for name, f in [("parser", parse), ("Message.parse", _message_parser(backend))]:
+        _report(out, family, backend, name, measure(f, frames));
+
+    # the common dispatch path, where only the header is looked at.
+    _report(out, family, "lazy", "LazyMessage.parse", measure(LazyMessage.parse, frames));
+
+  for name, ms in startup():
+    out.write("startup %-30s %8.1f ms\n" % (name, ms));
+
+  return failed;
+
+def entry():
+  count = 100;
+  seed = 0;
+
+  if len(sys.argv) > 1: count = int(sys.argv[1]);
+  if len(sys.argv) > 2: seed = int(sys.argv[2]);
+
+  if run(count, seed):
+    sys.exit(1);
+
+if __name__ == "__main__":
+  entry();
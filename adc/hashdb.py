@@ -0,0 +1,268 @@
+"""
+A persistent store of tree hashes for shared files.
+
+Every file is stored with the root hash and the hashes of one level of its
+tree (the leaves served for TTHL and used to verify downloads), keyed by
+(device, inode, path, size, mtime). An entry is only returned while the file
+still has the same key, so changed files are hashed again and unchanged
+files never are.
+
+    from adc.hashdb import HashDatabase
+
+    db = HashDatabase("hashes.db");
+    for path, e, hashed in db.update(paths):
+      print e.base32(), path
+"""
+
+from .merkletree import READSIZE
+
+import os
+import sqlite3
+import base64
+import collections
+
+"""
+Default level stored for every file, 2**6 segments or 64 KiB blocks for TigerTree.
+"""
+DEFAULT_LEVEL = 6;
+
+"""
+Number of paths per query in bulk lookups.
+"""
+LOOKUP_BATCH = 500;
+
+"""
+Number of hashed files stored per transaction by update.
+"""
+STORE_BATCH = 64;
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  device INTEGER NOT NULL,
+  inode INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  root BLOB NOT NULL,
+  level INTEGER NOT NULL,
+  leaves BLOB NOT NULL
+)
+""";
+
+_columns = "path, device, inode, size, mtime, root, level, leaves";
+
+class entry(collections.namedtuple("entry", _columns.replace(",", ""))):
+  """
+  A stored file, leaves are the concatenated hashes of the stored level.
+  """
+  __slots__ = ();
+
+  def key(self):
+    return (self.device, self.inode, self.path, self.size, self.mtime);
+
+  def base32(self):
+    return base64.b32encode(self.root);
+
+def filekey(path, st=None):
+  """
+  The (device, inode, path, size, mtime) key of a file, st is an optional os.stat result.
+  """
+  if st is None:
+    st = os.stat(path);
+
+  return (st.st_dev, st.st_ino, path, st.st_size, st.st_mtime);
+
+def hashfile(tree, path, level=None):
+  """
+  Hash a file with O(log n) memory, returns (root, leaves) where leaves are
+  the concatenated hashes of level, or None if no level is given.
+  """
+  with open(path, "rb") as fp:
+    if level is not None:
+      return tree.hashlevel(fp, level);
+
+    hasher = tree.hasher();
+
+    while True:
+      chunk = fp.read(READSIZE);
+
+      if not chunk:
+        break;
+
+      hasher.update(chunk);
+
+    return hasher.digest(), None;
+
+def _entry(row):
+  return entry(row[0], row[1], row[2], row[3], row[4], str(row[5]), row[6], str(row[7]));
+
+class HashDatabase(object):
+  """
+  Hashes of files stored in an sqlite database in WAL mode, so that readers
+  do not block while files are being hashed and stored.
+
+  tree is the MerkleTree implementation used (TigerTree by default) and level
+  the tree level stored for every file.
+  """
+  def __init__(self, path, tree=None, level=DEFAULT_LEVEL):
+    if tree is None:
+      from .tth import TigerTree as tree;
+
+    self.path = path;
+    self.tree = tree;
+    self.level = level;
+
+    self.connection = sqlite3.connect(path);
+    # paths are byte strings, stored and returned as is.
+    self.connection.text_factory = str;
+    self.connection.execute("PRAGMA journal_mode=WAL");
+    self.connection.execute("PRAGMA synchronous=NORMAL");
+
+    with self.connection:
+      self.connection.execute(_schema);
+
+  def close(self):
+    self.connection.close();
+
+  def __len__(self):
+    return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0];
+
+  def _stored(self, paths):
+    """
+    Stored entries by path, fresh or not.
+    """
+    paths = list(paths);
+    result = dict();
+
+    for i in xrange(0, len(paths), LOOKUP_BATCH):
+      batch = paths[i:i+LOOKUP_BATCH];
+      query = "SELECT " + _columns + " FROM files WHERE path IN (" + ",".join("?" * len(batch)) + ")";
+
+      for row in self.connection.execute(query, batch):
+        e = _entry(row);
+        result[e.path] = e;
+
+    return result;
+
+  def lookup(self, path, key=None):
+    """
+    The entry of path, or None if it is not stored, the file has changed or
+    another level is stored.
+    """
+    return self.lookup_many([path], key and [key]).get(path, None);
+
+  def lookup_many(self, paths, keys=None):
+    """
+    Fresh entries by path for all paths, keys are the already known filekeys of the paths.
+    """
+    paths = list(paths);
+
+    if keys is None:
+      keys = [filekey(p) for p in paths];
+
+    stored = self._stored(paths);
+    result = dict();
+
+    for path, key in zip(paths, keys):
+      e = stored.get(path, None);
+
+      if e is not None and e.key() == key and e.level == self.level:
+        result[path] = e;
+
+    return result;
+
+  def hashfile(self, path):
+    """
+    Hash a file, returns (root, leaves) where leaves are the hashes of the stored level.
+    """
+    return hashfile(self.tree, path, self.level);
+
+  def store_many(self, entries):
+    with self.connection:
+      self.connection.executemany(
+        "INSERT OR REPLACE INTO files (" + _columns + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(e.path, e.device, e.inode, e.size, e.mtime, sqlite3.Binary(e.root), e.level, sqlite3.Binary(e.leaves)) for e in entries]);
+
+  def hash(self, path):
+    """
+    The entry of path, hashing and storing the file if it is new or has changed.
+    None if the file does not exist.
+    """
+    for path, e, hashed in list(self.update([path])):
+      return e;
+
+    return None;
+
+  def update(self, paths):
+    """
+    Incrementally rehash paths, generates (path, entry, hashed) in the same
+    order as paths, where hashed tells if the file had to be hashed.
+
+    Files which disappear while updating are skipped.
+    """
+    paths = list(paths);
+    pending = list();
+
+    try:
+      for i in xrange(0, len(paths), LOOKUP_BATCH):
+        batch = list();
+
+        for path in paths[i:i+LOOKUP_BATCH]:
+          try:
+            batch.append((path, filekey(path)));
+          except OSError:
+            pass;
+
+        fresh = self.lookup_many([p for p, k in batch], [k for p, k in batch]);
+
+        for path, key in batch:
+          e = fresh.get(path, None);
+
+          if e is not None:
+            yield path, e, False;
+            continue;
+
+          try:
+            root, leaves = self.hashfile(path);
+          except (IOError, OSError):
+            continue;
+
+          device, inode, path, size, mtime = key;
+          e = entry(path, device, inode, size, mtime, root, self.level, leaves);
+          pending.append(e);
+
+          if len(pending) >= STORE_BATCH:
+            self.store_many(pending);
+            pending = list();
+
+          yield path, e, True;
+    finally:
+      if pending:
+        self.store_many(pending);
+
+  def invalidate(self, paths):
+    """
+    Remove paths from the database.
+    """
+    with self.connection:
+      self.connection.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths]);
+
+  def prune(self):
+    """
+    Remove every stale entry, which is every file that is gone or has changed, returns the removed paths.
+    """
+    stale = list();
+
+    for row in self.connection.execute("SELECT " + _columns + " FROM files").fetchall():
+      e = _entry(row);
+
+      try:
+        key = filekey(e.path);
+      except OSError:
+        key = None;
+
+      if key != e.key():
+        stale.append(e.path);
+
+    self.invalidate(stale);
+    return stale;
@@ -1,26 +1,224 @@
-from mhash import MHASH, MHASH_TIGER
+import struct
 
-__all__ = ['TigerHash'];
+__all__ = ['TigerHash', 'TigerBackend', 'MhashTiger', 'GcryptTiger', 'BACKENDS', 'getBackend'];
 
 class HashMethod:
     size = 0;
 
     def __init__(self, name):
         self.name = name;
-    
+
     def digest(self, *chunks):
         raise Exception("HashMethod");
 
+class TigerBackend(object):
+    """
+    A Tiger implementation.
+
+    Besides digest, a backend hashes many tree nodes in one call. leaves hashes
+    every segment of a buffer as a leaf, nodes hashes every pair of hashes in a
+    level as an interior node. Both return the concatenated digests.
+
+    Subclasses only have to implement digest, but should override leaves and
+    nodes to avoid the per node overhead.
+    """
+    name = None;
+    size = 24;
+
+    def digest(self, *chunks):
+        raise NotImplementedError("digest");
+
+    def leaves(self, data, segment):
+        digest = self.digest;
+        return ''.join([digest("\x00", data[i:i+segment]) for i in xrange(0, len(data), segment)]);
+
+    def nodes(self, level):
+        digest = self.digest;
+        pair = self.size * 2;
+        end = len(level) - len(level) % pair;
+        return ''.join([digest("\x01", level[i:i+pair]) for i in xrange(0, end, pair)]);
+
+class MhashTiger(TigerBackend):
+    """
+    The reference backend using python-mhash.
+
+    mhash returns the three 64 bit words of Tiger in the opposite byte order,
+    they are swapped with a single unpack and pack. The states for the leaf and
+    node prefixes are prepared once and copied for every node, and nodes are
+    passed to mhash as buffers into data so they are never copied.
+    """
+    name = "mhash";
+
+    _big = struct.Struct(">3Q");
+    _little = struct.Struct("<3Q");
+
+    def __init__(self):
+        from mhash import MHASH, MHASH_TIGER
+
+        self._new = lambda: MHASH(MHASH_TIGER);
+
+        self._leaf = self._new();
+        self._leaf.update("\x00");
+
+        self._node = self._new();
+        self._node.update("\x01");
+
+    def _swap(self, d):
+        return self._little.pack(*self._big.unpack(d));
+
+    def digest(self, *chunks):
+        h = self._new();
+
+        for chunk in chunks:
+            h.update(chunk);
+
+        return self._swap(h.digest());
+
+    def _many(self, prototype, data, step, end):
+        copy = prototype.copy;
+        pack = self._little.pack;
+        unpack = self._big.unpack;
+        result = list();
+
+        for i in xrange(0, end, step):
+            h = copy();
+            h.update(buffer(data, i, step));
+            result.append(pack(*unpack(h.digest())));
+
+        return ''.join(result);
+
+    def leaves(self, data, segment):
+        return self._many(self._leaf, data, segment, len(data));
+
+    def nodes(self, level):
+        pair = self.size * 2;
+        return self._many(self._node, level, pair, len(level) - len(level) % pair);
+
+class GcryptTiger(TigerBackend):
+    """
+    A backend calling libgcrypt through ctypes.
+
+    Every node is hashed by a single gcry_md_hash_buffer call, which writes
+    the digest straight into a buffer holding the whole level. No hash object
+    is created per node, and the buffer is per call so the backend can be
+    shared between threads. Each node is copied once, prefixed with its leaf
+    or node byte, which is cheaper than passing the prefix and a pointer into
+    data as separate buffers.
+    """
+    name = "gcrypt";
+
+    # GCRY_MD_TIGER1, Tiger with the original padding as used by TTH.
+    _TIGER1 = 306;
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        path = ctypes.util.find_library("gcrypt");
+
+        if path is None:
+            raise ImportError("libgcrypt not found");
+
+        lib = ctypes.CDLL(path);
+        lib.gcry_check_version.restype = ctypes.c_char_p;
+
+        if lib.gcry_check_version(None) is None:
+            raise ImportError("libgcrypt could not be initialized");
+
+        self._ctypes = ctypes;
+        self._hash = lib.gcry_md_hash_buffer;
+        self._hash.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t];
+        self._hash.restype = None;
+
+    def digest(self, *chunks):
+        data = ''.join(chunks);
+        result = self._ctypes.create_string_buffer(self.size);
+        self._hash(self._TIGER1, self._ctypes.addressof(result), data, len(data));
+        return result.raw;
+
+    def _many(self, prefix, data, step, end):
+        size = self.size;
+        count = (end + step - 1) // step;
+        result = self._ctypes.create_string_buffer(count * size);
+        address = self._ctypes.addressof(result);
+        h = self._hash;
+        algo = self._TIGER1;
+
+        for j in xrange(count):
+            node = prefix + data[j*step:min(j*step+step, end)];
+            h(algo, address + j * size, node, len(node));
+
+        return result.raw;
+
+    def leaves(self, data, segment):
+        return self._many("\x00", data, segment, len(data));
+
+    def nodes(self, level):
+        pair = self.size * 2;
+        return self._many("\x01", level, pair, len(level) - len(level) % pair);
+
+"""
+Tiger backends by name, see getBackend.
+"""
+BACKENDS = {
+    "mhash": MhashTiger,
+    "gcrypt": GcryptTiger,
+};
+
+"""
+Backends tried in order when no name is given, the first one which loads is used.
+mhash is the reference implementation.
+"""
+PREFERRED_BACKENDS = ["gcrypt", "mhash"];
+
+"""
+Name of the backend used when no name is given, None picks from PREFERRED_BACKENDS.
+"""
+DEFAULT_BACKEND = None;
+
+_backends = dict();
+
+def _defaultBackend():
+    if DEFAULT_BACKEND is not None:
+        return getBackend(DEFAULT_BACKEND);
+
+    errors = list();
+
+    for name in PREFERRED_BACKENDS:
+        try:
+            return getBackend(name);
+        except ImportError, e:
+            errors.append(name + ": " + str(e));
+
+    raise ImportError("no tiger backend available (" + ", ".join(errors) + ")");
+
+def getBackend(name=None):
+    """
+    The shared instance of a backend, the default backend if name is None.
+    """
+    if name is None:
+        backend = _backends.get(None, None);
+
+        if backend is None:
+            backend = _defaultBackend();
+            _backends[None] = backend;
+
+        return backend;
+
+    backend = _backends.get(name, None);
+
+    if backend is None:
+        if name not in BACKENDS:
+            raise ValueError("no such tiger backend: " + repr(name));
+
+        backend = BACKENDS[name]();
+        _backends[name] = backend;
+
+    return backend;
+
 class TigerHash:
     size = 24;
-    
+
     @classmethod
     def digest(klass, *chunks):
-        h=MHASH(MHASH_TIGER);
-        
-        for chunk in chunks:
-          h.update(chunk);
-        
-        d = h.digest();
-        
-        return ''.join([d[i*8:i*8 + 8][::-1] for i in range(klass.size)]);
+        return getBackend().digest(*chunks);
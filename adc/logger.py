@@ -2,15 +2,162 @@ import logging
 
 import sys;
 import time;
+import threading;
+import Queue;
+
+def _str(s):
+    if type(s) is str:
+        return s;
+
+    if isinstance(s, unicode):
+        return s.encode("utf-8");
+
+    try:
+        return str(s);
+    except UnicodeError:
+        return unicode(s).encode("utf-8");
+
+def _encode(*msg):
+    """
+    msg as an utf-8 byte string, byte strings (e.g. received lines) are written as they are.
+    """
+    return ' '.join(_str(s) for s in msg)
+
+_timestamp = [None, None];
+
+def timestamp(now):
+    """
+    The formatted local time of now, only formatted once per second.
+    """
+    second = int(now);
+    cached = _timestamp;
+
+    if cached[0] != second:
+        cached[1] = time.strftime("%Y-%m-%d %H:%M:%S%z", time.localtime(second));
+        cached[0] = second;
+
+    return cached[1];
+
+def formatRecord(record):
+    """
+    Format a log record, the (time, logLevel, klass, prefixes, msg) tuple built by Logger.msg.
+    """
+    now, logLevel, klass, prefixes, msg = record;
+    return _encode(timestamp(now), "[" + klass + "]", "[" + _encode(*prefixes) + "]", _encode(*msg));
+
+class AsyncSink(object):
+    """
+    Writes log records to a stream from a background thread.
+
+    Records are formatted in the writer thread, and written in batches with a
+    single write. At most maxsize records wait, further records are dropped
+    and counted in dropped, a line with the number of dropped records is
+    written once there is room again. Records which can not be formatted and
+    batches which fail to be written are counted in errors.
+    """
+    delimiter = "\n";
+
+    def __init__(self, stream=None, maxsize=10000, batch=256):
+        if stream is None:
+            stream = sys.stdout;
+
+        self.stream = stream;
+        self.batch = batch;
+        self.queue = Queue.Queue(maxsize);
+        self.dropped = 0;
+        self.reported = 0;
+        self.written = 0;
+        self.errors = 0;
+        self.stopping = False;
+
+        self.thread = threading.Thread(target=self.run, name="adc-logger");
+        self.thread.daemon = True;
+        self.thread.start();
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record);
+        except Queue.Full:
+            self.dropped += 1;
+
+    def run(self):
+        while True:
+            records = [self.queue.get()];
+
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait());
+            except Queue.Empty:
+                pass;
+
+            stop = None in records;
+
+            try:
+                self.write(records);
+            except Exception:
+                # a failing stream (e.g. a closed stdout) must not stop the writer.
+                self.errors += 1;
+            finally:
+                for r in records:
+                    self.queue.task_done();
+
+            if stop or (self.stopping and self.queue.empty()):
+                return;
+
+    def write(self, records):
+        lines = list();
+
+        for r in records:
+            if r is None:
+                continue;
+
+            # a record which can not be formatted must not cost the rest of the batch.
+            try:
+                lines.append(formatRecord(r) + self.delimiter);
+            except Exception:
+                self.errors += 1;
+
+        formatted = len(lines);
+        dropped = self.dropped;
+
+        if dropped != self.reported:
+            lines.append(formatRecord((time.time(), logging.WARN, "AsyncSink", (), ("dropped", dropped - self.reported, "log records"))) + self.delimiter);
+            self.reported = dropped;
+
+        if lines:
+            self.stream.write(''.join(lines));
+            self.stream.flush();
+            self.written += formatted;
+
+    def flush(self):
+        """
+        Block until every queued record has been written.
+        """
+        self.queue.join();
+
+    def close(self, timeout=5.0):
+        """
+        Stop the writer thread once the queued records are written, waits at most timeout seconds.
+        """
+        self.stopping = True;
+
+        try:
+            self.queue.put_nowait(None);
+        except Queue.Full:
+            # the writer stops when it finds the queue empty.
+            pass;
+
+        self.thread.join(timeout);
 
 class Logger:
     delimiter = "\n";
 
-    def __init__(self, klass, *prefixes):
+    def __init__(self, klass, *prefixes, **kw):
         self.stream = sys.stdout;
         self.klass = klass.__name__;
         self.logLevel = logging.DEBUG;
         self.prefixes = prefixes;
+        self.sink = kw.get("sink", None);
 
     def setPrefixes(self, *prefixes):
         self.prefixes = prefixes;
@@ -18,17 +165,37 @@ class Logger:
     def setLogLevel(self, logLevel):
         self.logLevel = logLevel;
 
-    def __encode(self, *msg):
-        return ' '.join(str(s).encode("utf-8") for s in msg)
+    def setSink(self, sink):
+        """
+        Send records to sink (e.g. an AsyncSink) instead of writing them to stream.
+        """
+        self.sink = sink;
+
+    def enabled(self, logLevel):
+        """
+        If messages at logLevel are logged, use to avoid building expensive messages.
+        """
+        return self.logLevel <= logLevel;
 
     def onMessageLine(self, s, logLevel):
         self.stream.write(s + self.delimiter);
     
     def msg(self, *msg, **kw):
+        """
+        Log msg, a sequence of objects which are only converted to strings if
+        the message is logged.
+        """
         logLevel = kw.get("logLevel", logging.INFO);
-        if self.logLevel <= logLevel:
-            now = time.strftime("%Y-%m-%d %H:%M:%S%z")
-            self.onMessageLine(self.__encode(now, "[" + self.klass + "]", "[" + self.__encode(*self.prefixes) + "]", self.__encode(*msg)), logLevel);
+
+        if self.logLevel > logLevel:
+            return;
+
+        record = (time.time(), logLevel, self.klass, self.prefixes, msg);
+
+        if self.sink is not None:
+            self.sink.put(record);
+        else:
+            self.onMessageLine(formatRecord(record), logLevel);
     
     def err(self, *msg):
         import traceback;
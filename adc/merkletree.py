@@ -1,20 +1,39 @@
+import os;
 import types;
 import base64;
 import collections;
 
 node = collections.namedtuple("node", "left right hash");
 
+"""
+Number of bytes read at a time when hashing a file object.
+"""
+READSIZE = 1024 * 1024;
+
+"""
+Files of at least this many bytes are memory mapped by MerkleTree.from_path.
+"""
+MMAP_THRESHOLD = 1024 * 1024;
+
 class MerkleTree:
+  """
+  A hash tree stored as a list of levels, leaves first and the root last.
+
+  Each level is a single string with the concatenated hashes of that level,
+  an odd node at the end of a level is promoted unchanged to the next one.
+  """
   segment = 1024;
   hashsize = 0;
   
   def __init__(self, data, **kw):
     if type(data) == file:
-      self.root = self._hash_fp(data);
+      self.levels = self._hash_fp(data);
     elif type(data) == str:
-      self.root = self._hash_text(data);
+      self.levels = self._hash_text(data);
+    elif type(data) == list:
+      self.levels = data;
     else:
-      self.root = data;
+      self.levels = self._from_node(data);
 
   @staticmethod
   def _hash(*chunks):
@@ -28,137 +47,609 @@ class MerkleTree:
   def _lh(klass, *chunks):
     return klass._hash("\x00", *chunks);
   
+  @classmethod
+  def _leaves(klass, data):
+    """
+    The concatenated leaf hashes of every segment in data, which is a string
+    or any other object with the buffer interface (e.g. an mmap).
+    """
+    hs = klass.segment;
+    return ''.join([klass._lh(data[i:i+hs]) for i in xrange(0, len(data), hs)]);
+
+  @classmethod
+  def _nodes(klass, level):
+    """
+    The concatenated hashes of every pair of nodes in level.
+    """
+    hs = klass.hashsize;
+    end = len(level) - len(level) % (hs * 2);
+    return ''.join([klass._ih(level[i:i+hs], level[i+hs:i+hs*2]) for i in xrange(0, end, hs * 2)]);
+  
   @classmethod
   def _hash_text(klass, text):
-    nodes = list();
-    
-    for i in range(0, len(text), klass.segment):
-      nodes.append(node(None, None, klass._lh(text[i:i+klass.segment])))
-    
-    return klass._build_tree(nodes);
+    return klass._build_levels(klass._leaves(text));
   
   @classmethod
   def _hash_fp(klass, fp):
-    nodes = list();
+    """
+    Hash a file by reading blocks of READSIZE bytes, a multiple of the segment size.
+    """
+    leaves = list();
+    size = max(1, READSIZE // klass.segment) * klass.segment;
     
     while True:
-      chunk = fp.read(klass.segment)
+      chunk = fp.read(size)
       
       if not chunk:
         break
       
-      nodes.append(node(None, None, klass._lh(chunk)))
+      leaves.append(klass._leaves(chunk))
     
-    return klass._build_tree(nodes);
+    return klass._build_levels(''.join(leaves));
 
   @classmethod
-  def _build_tree(klass, nodes):
-    if len(nodes) == 0:
-        return node(None, None, klass._lh(""));
+  def _hash_mmap(klass, fp):
+    """
+    Hash a non-empty file through a read only memory map of it.
+    """
+    import mmap;
     
-    if len(nodes) == 1:
-        return nodes[0];
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ);
     
-    while len(nodes) > 2:
-      acc = list();
+    try:
+      return klass._build_levels(klass._leaves(mm));
+    finally:
+      mm.close();
+
+  @classmethod
+  def from_path(klass, path, mmapsize=None):
+    """
+    Hash the file at path.
+
+    Files smaller than mmapsize (default MMAP_THRESHOLD) bytes are read at
+    once, larger files are memory mapped so that the file is never held in
+    memory as a whole. The mhash backend hashes segments through buffers
+    into the map without copying them, other backends (e.g. gcrypt) copy
+    one segment at a time.
+    """
+    if mmapsize is None:
+      mmapsize = MMAP_THRESHOLD;
+    
+    with open(path, "rb") as fp:
+      size = os.fstat(fp.fileno()).st_size;
       
-      quanta, mod = divmod(len(nodes), 2);
+      if size == 0 or size < mmapsize:
+        return klass(klass._hash_text(fp.read()));
       
-      for i in range(quanta):
-        l = nodes[i*2];
-        r = nodes[i*2+1];
-        acc.append(node(l, r, klass._ih(l.hash, r.hash)));
+      return klass(klass._hash_mmap(fp));
+
+  @classmethod
+  def _next_level(klass, level):
+    """
+    Hash every pair of nodes in level, an odd node is promoted as is.
+    """
+    hs = klass.hashsize;
+    
+    if len(level) % (hs * 2):
+      return klass._nodes(level) + level[-hs:];
+    
+    return klass._nodes(level);
+
+  @classmethod
+  def _build_levels(klass, leaves):
+    if len(leaves) == 0:
+      leaves = klass._lh("");
+    
+    levels = [leaves];
+    
+    while len(levels[-1]) > klass.hashsize:
+      levels.append(klass._next_level(levels[-1]));
+    
+    return levels;
+
+  @classmethod
+  def _from_node(klass, root):
+    """
+    Levels of a tree built from linked nodes.
+    """
+    levels = list();
+    nodes = [root];
+    
+    while nodes:
+      levels.append(''.join(n.hash for n in nodes));
+      nodes = [c for n in nodes for c in (n.left, n.right) if c is not None];
+    
+    levels.reverse();
+    return levels;
+
+  @property
+  def root(self):
+    """
+    The tree as linked nodes, only built when asked for.
+    """
+    hs = self.hashsize;
+    leaves = self.levels[0];
+    nodes = [node(None, None, leaves[i:i+hs]) for i in xrange(0, len(leaves), hs)];
+    
+    for level in self.levels[1:]:
+      acc = list();
       
-      if mod:
-        acc.append(node(nodes[-1], None, nodes[-1].hash));
+      for i in xrange(0, len(nodes), 2):
+        r = nodes[i+1] if i + 1 < len(nodes) else None;
+        acc.append(node(nodes[i], r, level[i // 2 * hs:i // 2 * hs + hs]));
       
       nodes = acc;
     
-    l = nodes[0];
-    
-    if len(nodes) == 1:
-      return node(l, None, klass._ih(l.hash))
-    else:
-      r = nodes[1];
-      return node(l, r, klass._ih(l.hash, r.hash))
+    return nodes[0];
+
+  def digest(self):
+    return self.levels[-1];
   
   def base32(self):
-    return base64.b32encode(self.root.hash);
+    return base64.b32encode(self.digest());
     
   def base16(self):
-    return base64.b16encode(self.root.hash);
+    return base64.b16encode(self.digest());
 
   def serialize(self):
-    result = [];
-    queue = [self.root];
+    """
+    All hashes breadth first, starting with the root.
+    """
+    return ''.join(reversed(self.levels));
 
-    while len(queue) > 0:
-      n = queue.pop();
-      result.append(n.hash);
-      if n.left: queue.insert(0, n.left);
-      if n.right: queue.insert(0, n.right);
+  @classmethod
+  def _level_sizes(klass, leaves):
+    sizes = [leaves];
+    
+    while leaves > 1:
+      leaves = (leaves + 1) // 2;
+      sizes.append(leaves);
     
-    return ''.join(result);
+    return sizes;
 
   @classmethod
-  def deserialize(klass, data, depth):
+  def deserialize(klass, data, depth=None):
     """
-    This is the simplest deserilization i could think of, reversibly calculate each row starting from the lowest.
+    Reverse of serialize, the number of leaves is solved from the number of hashes.
+
+    If depth is given, it is checked against the number of levels in the tree.
     """
+    hs = klass.hashsize;
     
-    import math;
+    if len(data) == 0 or len(data) % hs != 0:
+      raise ValueError("data is not valid hash data, not a multiple of " + str(hs) + " bytes");
     
-    if len(data) % klass.hashsize != 0:
-      raise ValueError("data is not valid hash data, not a multiple of 24 bytes");
+    count = len(data) // hs;
     
-    hashes = [data[i*klass.hashsize:i*klass.hashsize+klass.hashsize] for i in range(len(data) / klass.hashsize)]
+    # the number of hashes in a tree only grows with the number of leaves.
+    lo, hi = 1, count;
     
-    nodes = list();
-
-    def _calc_segments(depths, ns, depth):
-      if ns <= 0: return 0;
-      if depth >= len(depths): return ns + 1;
-      
-      depths[depth] += 1;
-      
-      ns = _calc_segments(depths, ns - 1, depth + 1);
-      ns = _calc_segments(depths, ns - 1, depth + 1);
-      
-      return ns;
-
-    def calc_segments(ns, depth):
-      depths = [0 for x in range(depth)];
-      
-      depths[0] = 1;
-      ns = _calc_segments(depths, ns - 1, 1);
-      ns = _calc_segments(depths, ns - 1, 1);
+    while lo < hi:
+      mid = (lo + hi) // 2;
       
-      depths.reverse();
-      return depths;
+      if sum(klass._level_sizes(mid)) < count:
+        lo = mid + 1;
+      else:
+        hi = mid;
     
-    for seg in calc_segments(len(hashes), depth):
-      acc = list();
-      
-      for i, h in enumerate(hashes[-seg:]):
-        if len(nodes) > i*2:   l = nodes[i*2];
-        else:                  l = None;
-        if len(nodes) > i*2+1: r = nodes[i*2+1];
-        else:                  r = None;
-        acc.append(node(l, r, h));
-      
-      hashes = hashes[:-seg]
-      nodes = acc;
+    sizes = klass._level_sizes(lo);
+    
+    if sum(sizes) != count:
+      raise ValueError("data is not valid hash data, no tree has " + str(count) + " hashes");
+    
+    if depth is not None and len(sizes) != depth:
+      raise ValueError("data is not valid hash data, expected depth " + str(depth) + " but was " + str(len(sizes)));
     
-    return klass(nodes[0]);
+    levels = list();
+    end = len(data);
+    
+    for size in sizes:
+      levels.append(data[end - size * hs:end]);
+      end -= size * hs;
+    
+    return klass(levels);
   
   def __eq__(self, o):
-    def _check(n1, n2):
-      if n1 is None and n2 is None: return True;
-      if n1 is None: return False;
-      if n2 is None: return False;
-      return n1.hash == n2.hash and _check(n1.left, n2.left) and _check(n1.right, n2.right);
-    
-    return _check(self.root, o.root);
+    return self.levels == o.levels;
 
   def __ne__(self, o):
     return not self.__eq__(o);
+
+  @classmethod
+  def depth(klass, size):
+    """
+    Number of levels in the tree over size bytes.
+    """
+    return len(klass._level_sizes(max(1, (size + klass.segment - 1) // klass.segment)));
+
+  @classmethod
+  def findlevel(klass, depth, blocksize=None, levels=None):
+    """
+    The level (0 being the leaves) in a tree of depth levels which either
+    has nodes covering blocksize bytes, or is the lowest of the top levels.
+
+    If the tree is not high enough, this is the root level. depth may be
+    None for a blocksize, the level is then not limited.
+    """
+    if (blocksize is None) == (levels is None):
+      raise ValueError("exactly one of blocksize and levels is required");
+
+    if levels is not None:
+      if depth is None:
+        raise ValueError("levels requires the depth of the tree");
+
+      if levels < 1:
+        raise ValueError("levels must be at least 1: " + repr(levels));
+
+      return max(0, depth - levels);
+
+    level = 0;
+
+    while klass.segment << level < blocksize:
+      level += 1;
+
+    if klass.segment << level != blocksize:
+      raise ValueError("blocksize is not the segment size times a power of two: " + repr(blocksize));
+
+    if depth is None:
+      return level;
+
+    return min(level, depth - 1);
+
+  def level(self, n):
+    """
+    The concatenated hashes of level n, or of the root if the tree is lower than that.
+    """
+    return self.levels[min(n, len(self.levels) - 1)];
+
+  def tthl(self, blocksize=None, levels=None):
+    """
+    The hashes of the level with blocks of blocksize bytes, or the lowest of
+    the top levels, as served for TTHL requests.
+    """
+    return self.level(self.findlevel(len(self.levels), blocksize, levels));
+
+  @classmethod
+  def hashlevel(klass, fp, level):
+    """
+    Hash a file object, returns the root and the concatenated hashes of level.
+    Only that level is kept while hashing, nothing below it.
+    """
+    hasher = klass.hasher(level);
+
+    while True:
+      chunk = fp.read(READSIZE);
+
+      if not chunk:
+        break;
+
+      hasher.update(chunk);
+
+    return hasher.digest(), ''.join(hasher.levelhashes());
+
+  @classmethod
+  def streamtthl(klass, fp, blocksize=None, levels=None, size=None):
+    """
+    Like tthl, but for a file object which is hashed without building the
+    tree. size is only needed for levels, and defaults to the size of the file.
+    Returns the root and the level hashes.
+    """
+    depth = None;
+
+    if levels is not None:
+      if size is None:
+        size = os.fstat(fp.fileno()).st_size;
+
+      depth = klass.depth(size);
+
+    return klass.hashlevel(fp, klass.findlevel(depth, blocksize, levels));
+
+  @classmethod
+  def verifier(klass, root, hashes, blocksize, size=None):
+    """
+    A verifier for segments of the file with root and level hashes, see MerkleVerifier.
+    """
+    return MerkleVerifier(klass, root, hashes, blocksize, size);
+
+  @classmethod
+  def hasher(klass, level=None):
+    """
+    An incremental hasher producing the same root as this tree, see MerkleHasher.
+    """
+    return MerkleHasher(klass, level);
+
+  @classmethod
+  def parallel(klass, path, workers=None, minsplit=None):
+    """
+    The root hash of the file at path, hashed by a pool of worker processes, see parallel_digest.
+    """
+    return parallel_digest(klass, path, workers, minsplit);
+
+class MerkleHasher(object):
+  """
+  Incremental hashing with update/digest semantics.
+
+  Only a stack of pending subtree roots is kept, at most one per level, so
+  memory is O(log n) in the size of the input.
+
+  If level is given, the hashes of all nodes on that level (each covering
+  2**level segments) are retained as well and available through levelhashes.
+  """
+  def __init__(self, tree, level=None):
+    self.tree = tree;
+    self.level = level;
+    self.buffer = "";
+    self.count = 0;
+    self.stack = list();
+    self.retained = list();
+
+  def update(self, data):
+    segment = self.tree.segment;
+
+    if self.buffer:
+      data = self.buffer + data;
+
+    end = len(data) - len(data) % segment;
+    leaves = self.tree._leaves(data[:end]);
+    hs = self.tree.hashsize;
+
+    for i in xrange(0, len(leaves), hs):
+      self._push(leaves[i:i+hs]);
+
+    self.buffer = data[end:];
+
+  def _push(self, h):
+    """
+    Add the hash of a segment.
+    """
+    self.count += 1;
+    self._merge(self.stack, h, self.retained);
+
+  def _merge(self, stack, h, retained):
+    """
+    Push a segment hash on stack, merging every pair of equal level subtrees.
+    """
+    level = 0;
+
+    if self.level == 0:
+      retained.append(h);
+
+    while stack and stack[-1][0] == level:
+      h = self.tree._ih(stack.pop()[1], h);
+      level += 1;
+
+      if level == self.level:
+        retained.append(h);
+
+    stack.append((level, h));
+
+  def _pending(self):
+    """
+    Copies of the stack and the retained level, including the trailing partial segment.
+    """
+    stack = list(self.stack);
+    retained = list(self.retained);
+
+    # the empty input is hashed as a single empty segment.
+    if self.buffer or self.count == 0:
+      self._merge(stack, self.tree._lh(self.buffer), retained);
+
+    return stack, retained;
+
+  @staticmethod
+  def _fold(tree, stack):
+    """
+    Fold subtree roots right to left, odd nodes are promoted unchanged.
+    """
+    h = stack[-1][1];
+
+    for l in reversed(stack[:-1]):
+      h = tree._ih(l[1], h);
+
+    return h;
+
+  def digest(self):
+    """
+    The root hash of everything hashed so far, does not affect further updates.
+    """
+    return self._fold(self.tree, self._pending()[0]);
+
+  def base32(self):
+    return base64.b32encode(self.digest());
+
+  def levelhashes(self):
+    """
+    The hashes of the retained level, left to right. If the whole tree is lower
+    than the level, this is only the root.
+    """
+    if self.level is None:
+      raise ValueError("no level retained by this hasher");
+
+    stack, retained = self._pending();
+
+    if stack[0][0] < self.level:
+      return [self._fold(self.tree, stack)];
+
+    partial = [e for e in stack if e[0] < self.level];
+
+    if partial:
+      retained.append(self._fold(self.tree, partial));
+
+    return retained;
+
+class MerkleVerifier(object):
+  """
+  Verifies block aligned segments of a file as they arrive, against the root
+  and the hashes of one level of its tree (e.g. from TTHL).
+
+  Every node on that level covers blocksize bytes, so every block is
+  verified on its own and only the blocks which are bad need to be fetched
+  again. good and bad are the sets of block indexes verified so far.
+  """
+  def __init__(self, tree, root, hashes, blocksize, size=None):
+    hs = tree.hashsize;
+
+    if len(hashes) == 0 or len(hashes) % hs != 0:
+      raise ValueError("level hashes are not a multiple of " + str(hs) + " bytes");
+
+    tree.findlevel(None, blocksize);
+
+    if tree._build_levels(hashes)[-1] != root:
+      raise ValueError("level hashes do not match the root");
+
+    self.tree = tree;
+    self.root = root;
+    self.hashes = hashes;
+    self.blocksize = blocksize;
+    self.size = size;
+    self.blocks = len(hashes) // hs;
+    self.good = set();
+    self.bad = set();
+
+    if size is not None and max(1, (size + blocksize - 1) // blocksize) != self.blocks:
+      raise ValueError("level hashes do not cover " + str(size) + " bytes");
+
+  def blockhash(self, index):
+    hs = self.tree.hashsize;
+    return self.hashes[index * hs:index * hs + hs];
+
+  def verify(self, offset, data):
+    """
+    Verify data at offset, returns the (good, bad) block indexes in it.
+
+    offset has to be at the start of a block and data has to end at the end
+    of a block, or at the end of the file.
+    """
+    bs = self.blocksize;
+
+    if offset % bs != 0:
+      raise ValueError("offset is not at the start of a block: " + str(offset));
+
+    first = offset // bs;
+    count = (len(data) + bs - 1) // bs;
+
+    if first + count > self.blocks:
+      raise ValueError("segment is outside of the file: " + str(offset));
+
+    if count == 0 and (first != 0 or self.blocks != 1):
+      raise ValueError("empty segment, only the empty file has one");
+
+    if len(data) % bs != 0:
+      if first + count != self.blocks or (self.size is not None and offset + len(data) != self.size):
+        raise ValueError("segment does not end at the end of a block: " + str(offset + len(data)));
+
+    tree = self.tree;
+    good = list();
+    bad = list();
+
+    # the empty file is a single empty block.
+    for i in xrange(max(1, count)):
+      index = first + i;
+      block = data[i * bs:i * bs + bs];
+
+      # download buffers may also be a bytearray, buffer, memoryview or mmap.
+      if type(block) is memoryview:
+        block = block.tobytes();
+      elif type(block) is not str:
+        block = str(block);
+
+      if tree._build_levels(tree._leaves(block))[-1] == self.blockhash(index):
+        good.append(index);
+        self.good.add(index);
+        self.bad.discard(index);
+      else:
+        bad.append(index);
+        self.bad.add(index);
+        self.good.discard(index);
+
+    return good, bad;
+
+  def missing(self):
+    """
+    Indexes of the blocks which have not been verified as good.
+    """
+    return [i for i in xrange(self.blocks) if i not in self.good];
+
+  def complete(self):
+    return len(self.good) == self.blocks;
+
+"""
+Default smallest number of bytes hashed by a single worker in parallel_digest.
+"""
+PARALLEL_MINSPLIT = 16 * 1024 * 1024;
+
+"""
+Number of bytes read at a time by a worker.
+"""
+PARALLEL_READSIZE = 1024 * 1024;
+
+def _hash_range(task):
+  """
+  Root hash of the subtree over length bytes at offset of a file, runs in a worker.
+  """
+  klass, path, offset, length = task;
+  hasher = klass.hasher();
+
+  with open(path, "rb") as fp:
+    fp.seek(offset);
+
+    while length > 0:
+      chunk = fp.read(min(length, PARALLEL_READSIZE));
+
+      if not chunk:
+        raise IOError("file changed while hashing: " + path);
+
+      hasher.update(chunk);
+      length -= len(chunk);
+
+  return hasher.digest();
+
+def split_ranges(klass, size, workers, minsplit):
+  """
+  Split size bytes into (offset, length) ranges of which all but the last cover
+  a complete subtree, that is a power of two number of segments.
+
+  Ranges are at least minsplit bytes, and there are no more than four per
+  worker so that uneven progress evens out.
+  """
+  leaves = max(1, (size + klass.segment - 1) // klass.segment);
+  span = 1;
+
+  while span * klass.segment < minsplit or (leaves + span - 1) // span > workers * 4:
+    span *= 2;
+
+  step = span * klass.segment;
+  return [(offset, min(step, size - offset)) for offset in xrange(0, max(size, 1), step)];
+
+def parallel_digest(klass, path, workers=None, minsplit=None):
+  """
+  The root hash of the file at path, the same as klass(open(path)).digest().
+
+  The file is split with split_ranges and the root of each subtree is
+  hashed by one of workers processes (defaults to the number of cpus).
+  Since every subtree is complete, the roots form one level of the tree and
+  the remaining levels are built from them.
+  """
+  import multiprocessing;
+
+  if workers is None:
+    workers = multiprocessing.cpu_count();
+
+  if minsplit is None:
+    minsplit = PARALLEL_MINSPLIT;
+
+  size = os.path.getsize(path);
+  tasks = [(klass, path, offset, length) for offset, length in split_ranges(klass, size, workers, minsplit)];
+
+  if workers <= 1 or len(tasks) == 1:
+    roots = map(_hash_range, tasks);
+  else:
+    pool = multiprocessing.Pool(min(workers, len(tasks)));
+
+    try:
+      roots = pool.map(_hash_range, tasks, 1);
+    finally:
+      pool.terminate();
+      pool.join();
+
+  return klass._build_levels(''.join(roots))[-1];
@@ -1,13 +1,20 @@
 from . import parser
+from .arguments import encode, ENCODERS
 
-class Message:
+class Message(object):
+  __slots__ = ('_header', '_params', '_index', '_encoded', '_encodedheader');
+  
   def __init__(self, header=None, *params, **kw):
-    self.header = header
+    params = list(params);
+    
     for k, a in kw.items():
         if type(a) != list:
-            kw[k] = [a];
+            params.append(k + str(a));
+        else:
+            params.extend([k + str(v) for v in a]);
     
-    self.params = list(params) + reduce(lambda o, (nk, nv): o + [nk + str(v) for v in nv], kw.items(), [])
+    self.header = header;
+    self.params = params;
   
   @classmethod
   def create(klass, tree_root):
@@ -19,17 +26,96 @@ class Message:
         return Message();
 
   @classmethod
-  def parse(klass, string):
-    return klass.create(parser.parseFrame(string));
+  def parse(klass, string, backend=None):
+    """
+    Parse a frame using the given parser backend, see parser.PARSERS.
+    """
+    return klass.create(parser.getParser(backend)(string));
   
   def __repr__(self):
     return "<Message header=" + repr(self.header) + " params=" + repr(self.params) + ">"
 
   def __str__(self):
-    if self.header is None:
+    return self.encode();
+  
+  def encode(self):
+    """
+    The wire representation of this message (without eol).
+    
+    It is computed once and cached, so that a frame sent to many connections
+    is only serialized once. params is a tuple and can only be replaced, the
+    cache is also rebuilt when the header encodes differently (e.g. after
+    header.my_sid was changed).
+    """
+    if self._header is None:
       return "";
     
-    return parser.SEPARATOR.join([self.header.__str__()] + self.params)
+    header = self._header.__str__();
+    
+    if self._encoded is None or self._encodedheader != header:
+      self._encoded = parser.SEPARATOR.join((header,) + self.params);
+      self._encodedheader = header;
+    
+    return self._encoded;
+  
+  def invalidate(self):
+    """
+    Drop everything derived from header and params.
+    """
+    self._index = None;
+    self._encoded = None;
+  
+  def getheader(self):
+    return self._header;
+  
+  def setheader(self, header):
+    self._header = header;
+    self._encoded = None;
+  
+  header = property(getheader, setheader);
+  
+  def getparams(self):
+    return self._params;
+
+  def setparams(self, params):
+    self._params = tuple(params);
+    self.invalidate();
+
+  """
+  The parameters as a tuple, assigning params invalidates the named parameter
+  index and the encoded frame.
+  """
+  params = property(lambda self: self.getparams(), lambda self, params: self.setparams(params));
+
+  def getindex(self):
+    """
+    Named parameter index, built once per frame.
+
+    Returns a tuple (named, keys) where named maps each two letter key to its
+    values in order of appearance and keys is the order of all keys which
+    carry a value.
+    """
+    if self._index is None:
+      named = dict();
+      keys = list();
+      
+      for p in self.params:
+        if len(p) < 2:
+          continue;
+        
+        k = p[:2];
+        
+        if k in named:
+          named[k].append(p[2:]);
+        else:
+          named[k] = [p[2:]];
+        
+        if len(p) > 2:
+          keys.append(k);
+      
+      self._index = (named, keys);
+    
+    return self._index;
   
   def get(self, a_key):
     """
@@ -38,24 +124,74 @@ class Message:
     
     if isinstance(a_key, int):
         if a_key < 0 or a_key >= len(self.params):
-            raise ValueError("parameter index out of range: " + a_key);
+            raise ValueError("parameter index out of range: " + str(a_key));
         return self.params[a_key];
     
-    return map(lambda s: s[len(a_key):], filter(lambda v: v.startswith(a_key), self.params));
+    if len(a_key) != 2:
+        return map(lambda s: s[len(a_key):], filter(lambda v: v.startswith(a_key), self.params));
+    
+    return list(self.getindex()[0].get(a_key, []));
 
   def getfirst(self, a_key):
-    l = self.get(a_key);
-    if len(l) == 0:
+    if len(a_key) != 2:
+      l = self.get(a_key);
+    else:
+      l = self.getindex()[0].get(a_key);
+    
+    if not l:
       return None;
     return l[0];
   
   def getkeys(self):
-    return map(lambda s: s[:2], filter(lambda v: len(v) > 2, self.params));
+    return list(self.getindex()[1]);
 
   def haskey(self, k):
-    return k in self.getkeys();
+    named = self.getindex()[0];
+    
+    if k not in named:
+      return False;
+    
+    return any(named[k]);
 
-class Header:
+class LazyMessage(Message):
+  """
+  A message which only parses the header up front.
+
+  The raw line is kept together with the offset of the parameters, which are
+  split and unescaped the first time they are accessed. Note that this also
+  defers validation of the parameters until then.
+  """
+  __slots__ = ('line', 'offset');
+  
+  def __init__(self, header, line, offset):
+    self.header = header;
+    self.line = line;
+    self.offset = offset;
+    self._params = None;
+    self.invalidate();
+
+  @classmethod
+  def parse(klass, string):
+    tree, offset = parser.fastParseHeader(string);
+
+    if not tree:
+      return Message();
+
+    return klass(Header.create(tree), string, offset);
+
+  def getparams(self):
+    if self._params is None:
+      self._params = tuple(parser.fastParseParameters(self.line, self.offset));
+    return self._params;
+
+class Header(object):
+  __slots__ = ('type', 'cmd');
+  
+  """
+  Header fields following the command name on the wire, in order.
+  """
+  fields = ();
+  
   def __init__(self, tree_root=None, **kw):
     if tree_root:
         self.type = tree_root.get('type', None);
@@ -85,22 +221,27 @@ class Header:
     if header_type is None:
       return None;
     
-    header_type = header_type[0];
-    
-    if header_type in parser.B_HEADER:
-      return Broadcast(tree_root);
-    if header_type in parser.CIH_HEADER:
-      if header_type == 'C': return Client(tree_root);
-      if header_type == 'I': return Info(tree_root);
-      if header_type == 'H': return Hub(tree_root);
-    if header_type in parser.DE_HEADER:
-      if header_type == 'D': return Direct(tree_root);
-      if header_type == 'E': return Echo(tree_root);
-    if header_type in parser.F_HEADER: return Feature(tree_root);
-    if header_type in parser.U_HEADER: return UDP(tree_root);
-    return None;
+    header_klass = HEADERS.get(header_type[0], None);
+    
+    if header_klass is None:
+      return None;
+    
+    return header_klass.fromtree(tree_root);
+  
+  @classmethod
+  def fromtree(klass, tree_root):
+    """
+    Trusted construction path for headers produced by the parser, the grammar
+    already guarantees what the constructor would validate.
+    """
+    self = klass.__new__(klass);
+    self.type = tree_root.get('type');
+    self.cmd = tree_root.get('command_name');
+    return self;
 
 class Broadcast(Header):
+  __slots__ = ('my_sid',);
+  fields = ('my_sid',);
   validates = ['cmd', 'my_sid'];
   types = parser.B_HEADER;
   
@@ -114,6 +255,12 @@ class Broadcast(Header):
     
     Header.__init__(self, tree_root, **kw);
   
+  @classmethod
+  def fromtree(klass, tree_root):
+    self = super(Broadcast, klass).fromtree(tree_root);
+    self.my_sid = tree_root.get("my_sid");
+    return self;
+  
   def __repr__(self):
     return "<Broadcast cmd=" + repr(self.cmd) + " my_sid=" + repr(self.my_sid) + ">"
 
@@ -121,6 +268,7 @@ class Broadcast(Header):
     return parser.SEPARATOR.join([self.type + self.cmd, self.my_sid]);
 
 class CIH(Header):
+  __slots__ = ();
   validates = ['cmd'];
   types = parser.CIH_HEADER;
   
@@ -128,6 +276,7 @@ class CIH(Header):
     return self.type + self.cmd;
 
 class Client(CIH):
+  __slots__ = ();
   types = parser.CIH_HEADER;
   
   def __init__(self, *args, **kw):
@@ -138,6 +287,7 @@ class Client(CIH):
     return "<Client cmd=" + repr(self.cmd) + ">"
 
 class Info(CIH):
+  __slots__ = ();
   types = parser.CIH_HEADER;
   
   def __init__(self, *args, **kw):
@@ -148,6 +298,7 @@ class Info(CIH):
     return "<Info cmd=" + repr(self.cmd) + ">"
 
 class Hub(CIH):
+  __slots__ = ();
   types = parser.CIH_HEADER;
   
   def __init__(self, *args, **kw):
@@ -158,6 +309,8 @@ class Hub(CIH):
     return "<Hub cmd=" + repr(self.cmd) + ">"
 
 class DE(Header):
+  __slots__ = ('my_sid', 'target_sid');
+  fields = ('my_sid', 'target_sid');
   validates = ['cmd', 'my_sid', 'target_sid']
   types = parser.DE_HEADER;
   
@@ -171,10 +324,18 @@ class DE(Header):
     
     Header.__init__(self, tree_root, **kw);
   
+  @classmethod
+  def fromtree(klass, tree_root):
+    self = super(DE, klass).fromtree(tree_root);
+    self.my_sid = tree_root.get("my_sid");
+    self.target_sid = tree_root.get("target_sid");
+    return self;
+  
   def __str__(self):
     return parser.SEPARATOR.join([self.type + self.cmd, self.my_sid, self.target_sid]);
 
 class Direct(DE):
+  __slots__ = ();
   types = parser.DE_HEADER;
   
   def __init__(self, *args, **kw):
@@ -185,6 +346,7 @@ class Direct(DE):
     return "<Direct cmd=" + repr(self.cmd) + " my_sid=" + repr(self.my_sid) + " target_sid=" + repr(self.target_sid) + ">"
 
 class Echo(DE):
+  __slots__ = ();
   types = parser.DE_HEADER;
   
   def __init__(self, *args, **kw):
@@ -195,6 +357,8 @@ class Echo(DE):
     return "<Echo cmd=" + repr(self.cmd) + " my_sid=" + repr(self.my_sid) + " target_sid=" + repr(self.target_sid) + ">"
 
 class Feature(Header):
+  __slots__ = ('my_sid', 'add', 'rem');
+  fields = None;
   validates = ['cmd', 'my_sid']
   types = parser.F_HEADER;
   
@@ -223,14 +387,24 @@ class Feature(Header):
     
     Header.__init__(self, tree_root, **kw);
   
+  @classmethod
+  def fromtree(klass, tree_root):
+    self = super(Feature, klass).fromtree(tree_root);
+    self.my_sid = tree_root.get("my_sid");
+    self.add = [f for t, f in tree_root.get("feature_list") if t == parser.FEATURE_ADD];
+    self.rem = [f for t, f in tree_root.get("feature_list") if t == parser.FEATURE_REM];
+    return self;
+  
   def __repr__(self):
-    return "<Feature cmd=" + repr(self.cmd) + " my_sid=" + repr(self.my_sid) + " features=" + repr(self.features) + ">"
+    return "<Feature cmd=" + repr(self.cmd) + " my_sid=" + repr(self.my_sid) + " add=" + repr(self.add) + " rem=" + repr(self.rem) + ">"
   
   def __str__(self):
     features = [parser.FEATURE_ADD + feat for feat in self.add] + [parser.FEATURE_REM + feat for feat in self.rem];
     return parser.SEPARATOR.join([self.type + self.cmd, self.my_sid] + features);
 
 class UDP(Header):
+  __slots__ = ('my_cid',);
+  fields = ('my_cid',);
   validates = ['my_cid', 'type'];
   types = parser.U_HEADER;
   
@@ -242,10 +416,88 @@ class UDP(Header):
     
     Header.__init__(self, tree_root, **kw);
   
+  @classmethod
+  def fromtree(klass, tree_root):
+    self = super(UDP, klass).fromtree(tree_root);
+    self.my_cid = tree_root.get("my_cid");
+    return self;
+  
   def __repr__(self):
     return "<UDP cmd=" + repr(self.cmd) + " my_cid=" + repr(self.my_cid) + ">"
   
   def __str__(self):
     return parser.SEPARATOR.join([self.type + self.cmd, self.my_cid]);
 
-__all__ = [ "Message", "Client", "Info", "Hub", "Direct", "Echo", "Feature", "UDP", "Broadcast"];
+"""
+Header classes by message type, used by Header.create.
+"""
+HEADERS = {
+  'B': Broadcast,
+  'C': Client,
+  'I': Info,
+  'H': Hub,
+  'D': Direct,
+  'E': Echo,
+  'F': Feature,
+  'U': UDP,
+};
+
+"""
+Message types by header class.
+"""
+TYPES = dict((v, k) for k, v in HEADERS.items());
+
+class Template(object):
+  """
+  A precompiled outgoing frame.
+
+  The header type and command, and any fixed named parameters, are encoded
+  once. Each call to format only encodes the variable slots and
+  concatenates them:
+
+    BMSG = Template(Broadcast, 'MSG', None);
+    BMSG.format("AAAA", "hello world")   # -> "BMSG AAAA hello\\sworld"
+
+  format takes the header fields of the header class (e.g. my_sid) followed
+  by one value per slot. A slot is either None for a positional parameter or
+  a two letter key for a named parameter; named slots given None are left out.
+  The result is an encoded frame suitable for ADCProtocol.sendEncoded.
+  """
+  __slots__ = ('header', 'cmd', 'slots', 'prefix', 'suffix', 'size');
+  
+  def __init__(self, header, cmd, *slots, **fixed):
+    if header not in TYPES or header.fields is None:
+      raise ValueError("cannot build template for header: " + repr(header));
+    
+    if not parser._is_command_name(cmd):
+      raise ValueError("invalid command name: " + repr(cmd));
+    
+    for slot in slots:
+      if slot is not None and len(slot) != 2:
+        raise ValueError("slot must be None or a two letter key: " + repr(slot));
+    
+    self.header = header;
+    self.cmd = cmd;
+    self.slots = tuple(slot or "" for slot in slots);
+    self.prefix = TYPES[header] + cmd;
+    self.suffix = ''.join(parser.SEPARATOR + k + encode(v) for k, v in sorted(fixed.items()));
+    self.size = len(header.fields) + len(slots);
+  
+  def format(self, *values):
+    if len(values) != self.size:
+      raise ValueError("template " + self.prefix + " takes " + str(self.size) + " values, got " + str(len(values)));
+    
+    n = len(self.header.fields);
+    result = [self.prefix];
+    result.extend(values[:n]);
+    
+    for slot, v in zip(self.slots, values[n:]):
+      if v is None:
+        if slot: continue;
+        raise ValueError("positional parameter must not be None");
+      
+      result.append(slot + ENCODERS.get(type(v), encode)(v));
+    
+    return parser.SEPARATOR.join(result) + self.suffix;
+
+__all__ = [ "Message", "LazyMessage", "Template", "Client", "Info", "Hub", "Direct", "Echo", "Feature", "UDP", "Broadcast"];
@@ -1,7 +1,8 @@
-from pyparsing import *
 from .arguments import *
 
+import collections
 import string
+import re
 
 """
 The following module is a parser based on the ADC specification version 1.0:
@@ -20,22 +21,6 @@ DE_HEADER = ["D", "E"];
 F_HEADER = ["F"];
 U_HEADER = ["U"];
 
-"""
-A pyparser parsing with all methods encapsulated as static fields in this class.
-"""
-ParserElement.setDefaultWhitespaceChars("")
-ParserElement.enablePackrat();
-
-"""
-separator             ::= ' '
-"""
-separator             = Literal(SEPARATOR).suppress()
-
-"""
-eol                   ::= #x0a
-"""
-eol                   = Literal(EOL)
-
 """
 simple_alphanum       ::= [A-Z0-9]
 """
@@ -57,128 +42,443 @@ escape                ::= '\'
 escape                = "\\"
 
 """
-convenience functions for escaped_letter
+Size of the packrat cache used by the pyparsing grammar.
 """
-escaped_nl            = Literal(escape + "n").setParseAction(lambda s, l, t: "\n")
-escaped_s             = Literal(escape + "s").setParseAction(lambda s, l, t: " ")
-escaped_bs            = Literal(escape + escape).setParseAction(lambda s, l, t: "\\")
+PACKRAT_CACHE_SIZE = 4096;
 
-"""
-escaped_letter        ::= [^ \#x0a] | escape 's' | escape 'n' | escape escape
-"""
-escaped_letter        = (escaped_s | escaped_nl | escaped_bs) | Regex("[^ \n]")
+class _PackratCache(object):
+  """
+  Bounded fifo memo of parse results, private to the elements of this grammar
+  so that enabling packrat does not affect other pyparsing users.
+  """
+  def __init__(self, size):
+    self.size = size;
+    self.entries = dict();
+    self.order = collections.deque();
+  
+  def clear(self):
+    self.entries.clear();
+    self.order.clear();
+  
+  def packrat(self, element):
+    """
+    Make element memoize its results in this cache, see ParserElement._parseCache.
+    """
+    from pyparsing import ParseBaseException;
+    
+    parse = element._parseNoCache;
+    entries = self.entries;
+    
+    def _parse(instring, loc, doActions=True, callPreParse=True):
+      key = (element, instring, loc, callPreParse, doActions);
+      value = entries.get(key, None);
+      
+      if value is None:
+        try:
+          value = parse(instring, loc, doActions, callPreParse);
+        except ParseBaseException, pe:
+          self.set(key, pe.__class__(*pe.args));
+          raise;
+        
+        self.set(key, (value[0], value[1].copy()));
+        return value;
+      
+      if isinstance(value, Exception):
+        raise value;
+      
+      return value[0], value[1].copy();
+    
+    element._parse = _parse;
+  
+  def set(self, key, value):
+    self.entries[key] = value;
+    self.order.append(key);
+    
+    while len(self.order) > self.size:
+      self.entries.pop(self.order.popleft(), None);
+
+def _elements(root):
+  """
+  All elements reachable from root.
+  """
+  seen = dict();
+  queue = [root];
+  
+  while queue:
+    e = queue.pop();
+    
+    if id(e) in seen:
+      continue;
+    
+    seen[id(e)] = e;
+    queue.extend(getattr(e, 'exprs', []));
+    
+    if getattr(e, 'expr', None) is not None:
+      queue.append(e.expr);
+  
+  return seen.values();
+
+class Grammar(object):
+  """
+  The pyparsing grammar, all elements are available as attributes.
+  """
+  def __init__(self, elements):
+    self.__dict__.update(elements);
 
-"""
-feature_name          ::= simple_alpha simple_alphanum{3}
-"""
-feature_name          = Combine(Word(simple_alpha, exact=1) + Word(simple_alphanum, exact=3))
+def _build_grammar():
+  """
+  Builds the grammar, whitespace skipping is disabled for these elements only.
+  """
+  from pyparsing import ParserElement, Literal, Regex, Word, Combine, Group, Optional, OneOrMore, ZeroOrMore, StringEnd;
+  
+  white_chars = ParserElement.DEFAULT_WHITE_CHARS;
+  ParserElement.setDefaultWhitespaceChars("");
+  
+  try:
+    """
+    separator             ::= ' '
+    """
+    separator             = Literal(SEPARATOR).suppress()
+
+    """
+    eol                   ::= #x0a
+    """
+    eol                   = Literal(EOL)
+
+    """
+    convenience functions for escaped_letter
+    """
+    escaped_nl            = Literal(escape + "n").setParseAction(lambda s, l, t: "\n")
+    escaped_s             = Literal(escape + "s").setParseAction(lambda s, l, t: " ")
+    escaped_bs            = Literal(escape + escape).setParseAction(lambda s, l, t: "\\")
+
+    """
+    escaped_letter        ::= [^ \#x0a] | escape 's' | escape 'n' | escape escape
+    """
+    escaped_letter        = (escaped_s | escaped_nl | escaped_bs) | Regex("[^ \n]")
+
+    """
+    feature_name          ::= simple_alpha simple_alphanum{3}
+    """
+    feature_name          = Combine(Word(simple_alpha, exact=1) + Word(simple_alphanum, exact=3))
+
+    """
+    encoded_sid           ::= base32_character{4}
+    """
+    encoded_sid           = Word(base32_character, exact=4)
+
+    """
+    my_sid                ::= encoded_sid
+    """
+    my_sid                = encoded_sid.setResultsName('my_sid');
+
+    """
+    encoded_cid           ::= base32_character+
+    """
+    encoded_cid           = Word(base32_character)
+
+    """
+    my_cid                ::= encoded_cid
+    """
+    my_cid                = encoded_cid.setResultsName('my_cid');
+
+    """
+    target_sid            ::= encoded_sid
+    """
+    target_sid            = encoded_sid.setResultsName('target_sid')
+
+    """
+    command_name          ::= simple_alpha simple_alphanum simple_alphanum
+    """
+    command_name          = Combine(Word(simple_alpha, exact=1) + Word(simple_alphanum, exact=2)).setResultsName('command_name')
+
+    """
+    parameter_value       ::= escaped_letter+
+    """
+    parameter_value       = Combine(OneOrMore(escaped_letter))
+
+    """
+    parameter_type        ::= 'INT' | 'STR' | 'B32' | 'IP4' | 'IP6'
+    """
+    parameter_type        = (Literal(INT) | Literal(STR) | Literal(B32) | Literal(IP4) | Literal(IP6))
+
+    """
+    parameter_name        ::= simple_alpha simple_alphanum
+    """
+    parameter_name        = Combine(Word(simple_alpha, exact=1) + Word(simple_alphanum, exact=1))
+
+    """
+    parameter       ::= parameter_type ':' parameter_name (':' parameter_value)?
+    """
+    parameter       = parameter_value
+
+    """
+    convenience function for parameters
+    """
+    parameters      = ZeroOrMore(separator + parameter).setResultsName('parameters')
+
+    """
+    convenience function for f_message_header
+    """
+    feature_list         = OneOrMore(Group(separator + (Literal(FEATURE_ADD) | Literal(FEATURE_REM)) + feature_name)).setResultsName('feature_list')
+
+    """
+    b_message_header      ::= 'B' command_name separator my_sid
+    """
+    b_message_header      = Word(B_HEADER, exact=1).setResultsName('type') + command_name + separator + my_sid;
+
+    """
+    cih_message_header    ::= ('C' | 'I' | 'H') command_name
+    """
+    cih_message_header    = (Word(CIH_HEADER, exact=1)).setResultsName('type') + command_name
+
+    """
+    de_message_header     ::= ('D' | 'E') command_name separator my_sid separator target_sid
+    """
+    de_message_header     = Word(DE_HEADER, exact = 1).setResultsName('type') + command_name + separator + my_sid + separator + target_sid
+
+    """
+    f_message_header      ::= 'F' command_name separator my_sid separator (('+'|'-') feature_name)+
+    """
+    f_message_header      = Word(F_HEADER, exact=1).setResultsName('type') + command_name + separator + my_sid + feature_list
+
+    """
+    u_message_header      ::= 'U' command_name separator my_cid
+    """
+    u_message_header      = Word(U_HEADER, exact=1).setResultsName('type') + command_name + separator + my_cid
+
+    """
+    convenience function to match all different message headers.
+    """
+    message_header        = (b_message_header | cih_message_header | de_message_header | f_message_header | u_message_header).setResultsName('message_header');
+
+    """
+    message_body          ::= (b_message_header | cih_message_header | de_message_header | f_message_header | u_message_header | message_header)
+                              (separator parameter)*
+    """
+    message_body          = (message_header + parameters).setResultsName('message_body');
+
+    """
+    message               ::= message_body? eol
+    """
+    message               = Optional(message_body) + StringEnd();
+  finally:
+    ParserElement.setDefaultWhitespaceChars(white_chars);
+  
+  grammar = Grammar(dict((k, v) for k, v in locals().items() if isinstance(v, ParserElement)));
+  grammar.cache = _PackratCache(PACKRAT_CACHE_SIZE);
+  
+  message.streamline();
+  
+  for e in _elements(message):
+    grammar.cache.packrat(e);
+  
+  return grammar;
+
+_grammar = None;
+
+def getGrammar():
+  """
+  The pyparsing grammar, built on first use.
+  """
+  global _grammar;
+  
+  if _grammar is None:
+    _grammar = _build_grammar();
+  
+  return _grammar;
 
-"""
-encoded_sid           ::= base32_character{4}
-"""
-encoded_sid           = Word(base32_character, exact=4)
+def parseFrame(s):
+  """
+  Parses an entire frame and returns a tree of syntax nodes
+  """
+  grammar = getGrammar();
+  grammar.cache.clear();
+  return grammar.message.parseString(s, parseAll=True)
 
 """
-my_sid                ::= encoded_sid
-"""
-my_sid                = encoded_sid.setResultsName('my_sid');
+Hand-written fast path of the grammar above.
 
+Tokenizes on the separator and runs a small state machine over the header,
+producing a plain dict tree with the same result names as the pyparsing
+grammar so that Message.create can consume either of them.
 """
-encoded_cid           ::= base32_character+
-"""
-encoded_cid           = Word(base32_character)
+_simple_alpha         = frozenset(simple_alpha)
+_simple_alphanum      = frozenset(simple_alphanum)
+_base32_character     = frozenset(base32_character)
+_escapes              = {"s": " ", "n": "\n", escape: escape}
+_escape_sequence      = re.compile(r"\\([sn\\])")
 
-"""
-my_cid                ::= encoded_cid
-"""
-my_cid                = encoded_cid.setResultsName('my_cid');
+def _is_command_name(s):
+  return len(s) == 3 and s[0] in _simple_alpha and s[1] in _simple_alphanum and s[2] in _simple_alphanum
 
-"""
-target_sid            ::= encoded_sid
-"""
-target_sid            = encoded_sid.setResultsName('target_sid')
+def _is_feature_name(s):
+  return s[0] in _simple_alpha and s[1] in _simple_alphanum and s[2] in _simple_alphanum and s[3] in _simple_alphanum
 
-"""
-command_name          ::= simple_alpha simple_alphanum simple_alphanum
-"""
-command_name          = Combine(Word(simple_alpha, exact=1) + Word(simple_alphanum, exact=2)).setResultsName('command_name')
+def _is_encoded_sid(s):
+  return len(s) == 4 and _base32_character.issuperset(s)
 
-"""
-parameter_value       ::= escaped_letter+
-"""
-parameter_value       = Combine(OneOrMore(escaped_letter))
+def _is_encoded_cid(s):
+  return len(s) > 0 and _base32_character.issuperset(s)
 
-"""
-parameter_type        ::= 'INT' | 'STR' | 'B32' | 'IP4' | 'IP6'
-"""
-parameter_type        = (Literal(INT) | Literal(STR) | Literal(B32) | Literal(IP4) | Literal(IP6))
+def _unescape(s):
+  """
+  escaped_letter        ::= [^ \#x0a] | escape 's' | escape 'n' | escape escape
 
-"""
-parameter_name        ::= simple_alpha simple_alphanum
-"""
-parameter_name        = Combine(Word(simple_alpha, exact=1) + Word(simple_alphanum, exact=1))
+  Escape sequences not covered by the grammar are kept verbatim, just like
+  the fallback regex in escaped_letter does.
+  """
+  if escape not in s:
+    return s;
 
-"""
-parameter       ::= parameter_type ':' parameter_name (':' parameter_value)?
-"""
-parameter       = parameter_value
+  return _escape_sequence.sub(lambda m: _escapes[m.group(1)], s);
 
-"""
-convenience function for parameters
-"""
-parameters      = ZeroOrMore(separator + parameter).setResultsName('parameters')
+def _next_token(s, pos):
+  """
+  Return the token following the separator at pos and the offset right after it.
+  """
+  if pos >= len(s) or s[pos] != SEPARATOR:
+    raise ValueError("expected separator at " + str(pos) + " in frame: " + repr(s));
 
-"""
-convenience function for f_message_header
-"""
-feature_list         = OneOrMore(Group(separator + (Literal(FEATURE_ADD) | Literal(FEATURE_REM)) + feature_name)).setResultsName('feature_list')
+  end = s.find(SEPARATOR, pos + 1);
 
-"""
-b_message_header      ::= 'B' command_name separator my_sid
-"""
-b_message_header      = Word(B_HEADER, exact=1).setResultsName('type') + command_name + separator + my_sid;
+  if end == -1:
+    end = len(s);
 
-"""
-cih_message_header    ::= ('C' | 'I' | 'H') command_name
-"""
-cih_message_header    = (Word(CIH_HEADER, exact=1)).setResultsName('type') + command_name
+  return s[pos + 1:end], end;
 
-"""
-de_message_header     ::= ('D' | 'E') command_name separator my_sid separator target_sid
-"""
-de_message_header     = Word(DE_HEADER, exact = 1).setResultsName('type') + command_name + separator + my_sid + separator + target_sid
+def fastParseHeader(s):
+  """
+  Parses only the header of a frame.
 
-"""
-f_message_header      ::= 'F' command_name separator my_sid separator (('+'|'-') feature_name)+
-"""
-f_message_header      = Word(F_HEADER, exact=1).setResultsName('type') + command_name + separator + my_sid + feature_list
+  Returns a tuple (tree, offset) where tree has the same result names as
+  parseFrame (except for 'parameters') and s[offset:] is the unparsed
+  parameter part of the frame, which is either empty or starts with a separator.
+  """
+  if not s:
+    return dict(), 0;
+
+  if EOL in s:
+    raise ValueError("unexpected end of line in frame: " + repr(s));
+
+  if len(s) < 4 or not _is_command_name(s[1:4]):
+    raise ValueError("invalid message header in frame: " + repr(s));
+
+  header_type = s[0];
+  tree = {'type': header_type, 'command_name': s[1:4]};
+  message_header = [header_type, s[1:4]];
+  pos = 4;
+
+  if header_type in B_HEADER:
+    sid, pos = _next_token(s, pos);
+    if not _is_encoded_sid(sid):
+      raise ValueError("invalid my_sid in frame: " + repr(s));
+    tree['my_sid'] = sid;
+    message_header.append(sid);
+  elif header_type in CIH_HEADER:
+    pass;
+  elif header_type in DE_HEADER:
+    sid, pos = _next_token(s, pos);
+    target, pos = _next_token(s, pos);
+    if not _is_encoded_sid(sid) or not _is_encoded_sid(target):
+      raise ValueError("invalid my_sid or target_sid in frame: " + repr(s));
+    tree['my_sid'] = sid;
+    tree['target_sid'] = target;
+    message_header.extend([sid, target]);
+  elif header_type in F_HEADER:
+    sid, pos = _next_token(s, pos);
+    if not _is_encoded_sid(sid):
+      raise ValueError("invalid my_sid in frame: " + repr(s));
+    tree['my_sid'] = sid;
+    message_header.append(sid);
+
+    feature_list = list();
+
+    # greedy, like OneOrMore; a token which starts like a feature but is
+    # followed by anything except a separator can never be matched.
+    while pos < len(s):
+      t, end = _next_token(s, pos);
+
+      if len(t) < 5 or t[0] not in (FEATURE_ADD, FEATURE_REM) or not _is_feature_name(t[1:5]):
+        break;
+
+      if len(t) != 5:
+        raise ValueError("invalid feature in frame: " + repr(t));
+
+      feature_list.append((t[0], t[1:]));
+      message_header.append(feature_list[-1]);
+      pos = end;
+
+    if not feature_list:
+      raise ValueError("feature list must not be empty: " + repr(s));
+
+    tree['feature_list'] = feature_list;
+  elif header_type in U_HEADER:
+    cid, pos = _next_token(s, pos);
+    if not _is_encoded_cid(cid):
+      raise ValueError("invalid my_cid in frame: " + repr(s));
+    tree['my_cid'] = cid;
+    message_header.append(cid);
+  else:
+    raise ValueError("invalid message type: " + repr(header_type));
+
+  if pos < len(s) and s[pos] != SEPARATOR:
+    raise ValueError("expected separator at " + str(pos) + " in frame: " + repr(s));
+
+  tree['message_header'] = message_header;
+  tree['message_body'] = message_header;
+  return tree, pos;
+
+def fastParseParameters(s, offset):
+  """
+  Splits and unescapes the parameters of a frame, starting at the offset
+  returned by fastParseHeader.
+  """
+  if offset >= len(s):
+    return [];
 
-"""
-u_message_header      ::= 'U' command_name separator my_cid
-"""
-u_message_header      = Word(U_HEADER, exact=1).setResultsName('type') + command_name + separator + my_cid
+  parameters = s[offset + 1:].split(SEPARATOR);
 
-"""
-convenience function to match all different message headers.
-"""
-message_header        = (b_message_header | cih_message_header | de_message_header | f_message_header | u_message_header).setResultsName('message_header');
+  for p in parameters:
+    if not p:
+      raise ValueError("empty parameter in frame: " + repr(s));
 
-"""
-message_body          ::= (b_message_header | cih_message_header | de_message_header | f_message_header | u_message_header | message_header)
-                          (separator parameter)*
-"""
-message_body          = (message_header + parameters).setResultsName('message_body');
+  return [_unescape(p) for p in parameters];
+
+def fastParseFrame(s):
+  """
+  Parses an entire frame without pyparsing, accepts exactly the same
+  language as parseFrame and raises ValueError on invalid frames.
+  """
+  tree, offset = fastParseHeader(s);
+
+  if tree:
+    tree['parameters'] = fastParseParameters(s, offset);
+
+  return tree;
 
 """
-message               ::= message_body? eol
+Available frame parsers, the pyparsing grammar is kept as the reference
+implementation which the others must be validated against.
 """
-message               = Optional(message_body) + StringEnd();
+PARSERS = {
+  "pyparsing": parseFrame,
+  "fast": fastParseFrame,
+};
 
-def parseFrame(s):
+DEFAULT_PARSER = "pyparsing";
+
+def getParser(name=None):
   """
-  Parses an entire frame and returns a tree of syntax nodes
+  Look up a frame parser by name, or the default parser if name is None.
   """
-  return message.parseString(s, parseAll=True)
+  if name is None:
+    name = DEFAULT_PARSER;
+
+  if name not in PARSERS:
+    raise ValueError("no such parser: " + repr(name));
+
+  return PARSERS[name];
 
 __all__ = [
   "FEATURE_ADD",
@@ -191,5 +491,11 @@ __all__ = [
   "DE_HEADER",
   "F_HEADER",
   "U_HEADER",
-  "parseFrame"
+  "PARSERS",
+  "getGrammar",
+  "parseFrame",
+  "fastParseFrame",
+  "fastParseHeader",
+  "fastParseParameters",
+  "getParser"
 ];
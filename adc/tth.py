@@ -1,11 +1,207 @@
 from merkletree import MerkleTree
 
-from .hashing import TigerHash
+from .hashing import TigerHash, getBackend
 
 class TigerTree(MerkleTree):
   segment = 1024;
   hashsize = TigerHash.size;
+
+  # name of the tiger backend in adc.hashing.BACKENDS, None for the default.
+  backend = None;
   
   @classmethod
   def _hash(klass, *chunks):
-    return TigerHash.digest(*chunks);
+    return getBackend(klass.backend).digest(*chunks);
+
+  @classmethod
+  def _leaves(klass, data):
+    return getBackend(klass.backend).leaves(data, klass.segment);
+
+  @classmethod
+  def _nodes(klass, level):
+    return getBackend(klass.backend).nodes(level);
+
+def _walk(paths, err):
+  """
+  Every file in paths, directories are walked recursively in sorted order.
+  """
+  import os;
+
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path;
+      continue;
+
+    def _error(e):
+      err.write("adc-tthsum: " + str(e) + "\n");
+
+    for root, dirs, files in os.walk(path, onerror=_error):
+      dirs.sort();
+
+      for name in sorted(files):
+        yield os.path.join(root, name);
+
+def _hash_file(task):
+  """
+  Hash a single file in a worker, returns (root, leaves, size) or (None, error, 0).
+  """
+  from .hashdb import hashfile;
+  import os;
+
+  tree, path, level = task;
+
+  try:
+    size = os.path.getsize(path);
+    root, leaves = hashfile(tree, path, level);
+  except (IOError, OSError), e:
+    return None, str(e), 0;
+
+  return root, leaves, size;
+
+class _Stats(object):
+  def __init__(self, total, err, progress):
+    import time;
+    self.time = time.time;
+    self.start = self.time();
+    self.total = total;
+    self.err = err;
+    self.progress = progress;
+    self.files = 0;
+    self.hashed = 0;
+    self.cached = 0;
+    self.bytes = 0;
+    self.failed = 0;
+
+  def rates(self):
+    elapsed = max(self.time() - self.start, 1e-6);
+    return elapsed, self.bytes / elapsed / (1024.0 * 1024.0), self.hashed / elapsed;
+
+  def update(self):
+    if not self.progress:
+      return;
+
+    elapsed, mbs, fps = self.rates();
+    self.err.write("\r%d/%d files %.1f MiB/s %.1f files/s" % (self.files, self.total, mbs, fps));
+
+  def report(self):
+    elapsed, mbs, fps = self.rates();
+
+    if self.progress:
+      self.err.write("\n");
+
+    self.err.write("%d files (%d hashed, %d cached, %d failed), %.1f MiB in %.2f s: %.1f MiB/s %.1f files/s\n" % (
+      self.files, self.hashed, self.cached, self.failed, self.bytes / (1024.0 * 1024.0), elapsed, mbs, fps));
+
+def tthsum(paths, tree=TigerTree, jobs=None, cache=None, out=None, err=None, progress=False):
+  """
+  Write the root of every file in paths as a "TTH  path" line to out, in the
+  order the files are walked. Files are hashed by jobs worker processes
+  (defaults to the number of cpus), cache is an optional path to a
+  adc.hashdb.HashDatabase which is consulted first and updated.
+
+  Returns the number of files which could not be hashed.
+  """
+  import sys;
+  import base64;
+  import itertools;
+  import multiprocessing;
+  from .hashdb import HashDatabase, LOOKUP_BATCH, filekey, entry;
+
+  if out is None: out = sys.stdout;
+  if err is None: err = sys.stderr;
+  if jobs is None: jobs = multiprocessing.cpu_count();
+
+  files = list(_walk(paths, err));
+  stats = _Stats(len(files), err, progress);
+  db = None;
+  level = None;
+  pool = None;
+
+  if cache is not None:
+    db = HashDatabase(cache, tree);
+    level = db.level;
+
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs);
+    imap = pool.imap;
+  else:
+    imap = itertools.imap;
+
+  try:
+    for i in xrange(0, len(files), LOOKUP_BATCH):
+      batch = files[i:i+LOOKUP_BATCH];
+      keys = dict();
+      fresh = dict();
+
+      if db is not None:
+        for path in batch:
+          try:
+            keys[path] = filekey(path);
+          except OSError:
+            pass;
+
+        fresh = db.lookup_many(keys.keys(), keys.values());
+
+      misses = [(tree, path, level) for path in batch if path not in fresh];
+      results = imap(_hash_file, misses);
+      stored = list();
+
+      for path in batch:
+        stats.files += 1;
+
+        if path in fresh:
+          root = fresh[path].root;
+          stats.cached += 1;
+        else:
+          root, leaves, size = results.next();
+
+          if root is None:
+            stats.failed += 1;
+            err.write("adc-tthsum: " + leaves + "\n");
+            stats.update();
+            continue;
+
+          stats.hashed += 1;
+          stats.bytes += size;
+
+          if path in keys and keys[path][3] == size:
+            device, inode, path, size, mtime = keys[path];
+            stored.append(entry(path, device, inode, size, mtime, root, level, leaves));
+
+        out.write(base64.b32encode(root).rstrip("=") + "  " + path + "\n");
+        stats.update();
+
+      if stored:
+        db.store_many(stored);
+
+    out.flush();
+  finally:
+    if pool is not None:
+      pool.terminate();
+      pool.join();
+
+    if db is not None:
+      db.close();
+
+  stats.report();
+  return stats.failed;
+
+def entry():
+  import optparse;
+  import sys;
+
+  parser = optparse.OptionParser(usage="%prog [options] <file or directory>...");
+  parser.add_option("-j", "--jobs", type="int", default=None, help="number of worker processes (default: number of cpus)");
+  parser.add_option("-c", "--cache", default=None, help="hash database to consult and update");
+  parser.add_option("-p", "--progress", action="store_true", default=False, help="show progress");
+
+  options, args = parser.parse_args();
+
+  if len(args) < 1:
+    parser.error("no files given");
+
+  if tthsum(args, jobs=options.jobs, cache=options.cache, progress=options.progress) > 0:
+    sys.exit(1);
+
+if __name__ == "__main__":
+  entry();
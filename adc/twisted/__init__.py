@@ -1 +1,2 @@
 from .ctohprotocol import ADCHubProtocol, HubUser
+from .hashing import HashService
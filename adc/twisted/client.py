@@ -1,6 +1,5 @@
 from twisted.internet.protocol import ClientFactory
-from twisted.internet import reactor, defer, ssl
-from OpenSSL import SSL
+from twisted.internet import reactor, defer
 
 import uuid;
 
@@ -102,6 +101,10 @@ class ADCApplication:
         if hub.scheme == "adc":
             reactor.connectTCP(hub.host, hub.port, ADCClientToHub(hub, (hubc, hubd), self.log));
         elif hub.scheme == "adcs":
+            # only pull in OpenSSL for secure hubs.
+            from twisted.internet import ssl
+            from OpenSSL import SSL
+            
             ctx = ssl.ClientContextFactory();
             ctx.method = SSL.TLSv1_METHOD;
             reactor.connectSSL(hub.host, hub.port, ADCClientToHub(hub, (hubc, hubd), self.log), ctx);
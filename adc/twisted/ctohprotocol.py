@@ -1,7 +1,7 @@
 from .protocol import ADCProtocol, ADCContext
-from .helpers import ADCStatus
-from ..types import *
-from ..types import encode, decode
+from .helpers import ADCStatus, LocalInfo
+from ..arguments import *
+from ..arguments import encode, decode
 from ..message import *
 from ..hashing import TigerHash
 
@@ -15,7 +15,7 @@ class HubUser(object):
     'NI': ('nick', "twisteduser", STR),
     'SS': ('sharesize', 0, INT),
     'I4': ('ip4', None, IP4),
-    'I6': ('ip6', None, IP4),
+    'I6': ('ip6', None, IP6),
   };
 
   def __init__(self, **kw):
@@ -26,7 +26,8 @@ class HubUser(object):
     for k, v in self.TYPES.items():
       attr, default, t = v;
       
-      if k in kw:
+      # fields missing from an incremental INF are None, they keep their value.
+      if kw.get(k, None) is not None:
         setattr(self, attr, decode(kw[k], t));
       elif not hasattr(self, attr):
         setattr(self, attr, default);
@@ -71,7 +72,7 @@ class HubDescriptor:
     
     def disconnect(self):
         if self.connected:
-            self.protocol.transport.loseConnection();
+            self.protocol.loseConnection();
             self.connected = False;
     
     def sendMessage(self, message):
@@ -92,7 +93,14 @@ class ADCHubProtocol(ADCProtocol):
     """
     context = ADCContext("Hub Connection");
     
-    supported_features = set(["BASE", "ZLIB", "TIGR"]);
+    supported_features = set(["BASE", "ZLIB", "ZLIF", "TIGR"]);
+    
+    """
+    Compress everything sent to the hub once it has agreed on ZLIF.
+    """
+    deflate = False;
+    
+    BMSG = Template(Broadcast, 'MSG', None);
     
     signals = set([
       "hub-identified",
@@ -108,6 +116,7 @@ class ADCHubProtocol(ADCProtocol):
     
     def __init__(self, **kw):
       ADCProtocol.__init__(self, **kw);
+      self.deflate = kw.get("deflate", self.deflate);
       
       self.log.setPrefixes("n/a");
       self.hub = HubDescriptor(self);
@@ -118,6 +127,7 @@ class ADCHubProtocol(ADCProtocol):
       self.pid = None;
       self.cid = None;
       self.peer = None;
+      self.info = LocalInfo();
       
       self.__users = list();
       self.__users_by_sid = dict();
@@ -125,22 +135,40 @@ class ADCHubProtocol(ADCProtocol):
     def sendLogin(self, user):
       if user is None:
         self.log("user is None", logLevel=logging.ERROR);
-        self.transport.loseConnection();
+        self.loseConnection();
         return;
 
       if not self.hub.sid:
         self.log("Sid is not set", logLevel=logging.ERROR);
-        self.transport.loseConnection();
+        self.loseConnection();
+        return;
+      
+      self.info.sid = self.hub.sid;
+      self.info.set('NI', user.nick);
+      self.info.set('SS', user.sharesize);
+      self.info.set('ID', Base32(self.cid));
+      self.info.set('PD', Base32(self.pid));
+      
+      self.sendInfo(self.info.full());
+    
+    def updateInfo(self, **kw):
+      """
+      Update fields of the local user (e.g. SS, SL, HN), only the fields which
+      changed are sent, and only once the login INF has been sent.
+      """
+      for k, v in kw.items():
+        self.info.set(k, v);
+      
+      if not self.info.announced or not self.connected:
         return;
       
-      kw = {
-        'NI': encode(user.nick),
-        'SS': encode(user.sharesize),
-        'ID': encode(Base32(self.cid)),
-        'PD': encode(Base32(self.pid)),
-      };
+      fields = self.info.delta();
       
-      self.sendFrame(Message(Broadcast(cmd='INF', my_sid=encode(self.hub.sid)), **kw));
+      if fields:
+        self.sendInfo(fields);
+    
+    def sendInfo(self, fields):
+      self.sendFrame(Message(Broadcast(cmd='INF', my_sid=encode(self.hub.sid)), **fields));
 
     def connectionMade(self):
       ADCProtocol.connectionMade(self);
@@ -152,12 +180,12 @@ class ADCHubProtocol(ADCProtocol):
     
     def sendMessage(self, msg):
       if self.connected:
-        self.sendFrame(Message(Broadcast(cmd='MSG', my_sid=encode(self.hub.sid)), encode(msg)));
+        self.sendEncoded(self.BMSG.format(self.hub.sid, msg), droppable=True);
     
     @context(context.INITIAL)
     def do_initial(self):
         self.setState(self.context.PROTOCOL);
-        self.sendFrame(Message(Hub(cmd='SUP'), AD=self.hashes.keys() + ["BASE"]));
+        self.sendFrame(Message(Hub(cmd='SUP'), AD=self.hashes.keys() + ["BASE", "ZLIF"]));
         p = self.transport.getPeer();
         self.log.setPrefixes(p.host+ ":" + str(p.port));
 
@@ -181,6 +209,18 @@ class ADCHubProtocol(ADCProtocol):
         # features to remove
         for feature in RM:
             self.features.remove(feature);
+        
+        if self.deflate and "ZLIF" in self.features:
+            self.startDeflate(Message(Hub(cmd='ZON')));
+    
+    @context(context.PROTOCOL, Info, 'ZON')
+    @context(context.IDENTIFY, Info, 'ZON')
+    @context(context.NORMAL, Info, 'ZON')
+    def compressed_stream(self, frame):
+        """
+        Everything after this frame is zlib compressed, until the end of the zlib stream.
+        """
+        self.startInflate();
 
     @context(context.PROTOCOL, Info, 'SID')
     @context.params(STR)
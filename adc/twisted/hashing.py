@@ -0,0 +1,213 @@
+"""
+Tree hashing off the reactor thread.
+
+Hashing a large file takes seconds to minutes, which would block every
+connection on the reactor. HashService runs hash jobs in a bounded pool of
+threads (or processes) and returns Deferreds instead.
+"""
+
+from twisted.internet import defer, threads
+from twisted.python import threadpool
+
+from ..merkletree import READSIZE
+
+import heapq
+import itertools
+
+HIGH = 0;
+NORMAL = 10;
+LOW = 20;
+
+"""
+Seconds between checks for cancellation while a job runs in a worker process.
+"""
+PROCESS_POLL = 0.1;
+
+class QueueFull(Exception):
+  """
+  Raised (through the Deferred) when a job is submitted to a full HashService.
+  """
+  pass;
+
+class _Job(object):
+  __slots__ = ('priority', 'seq', 'f', 'args', 'deferred', 'cancelled');
+
+  def __init__(self, priority, seq, f, args):
+    self.priority = priority;
+    self.seq = seq;
+    self.f = f;
+    self.args = args;
+    self.deferred = None;
+    self.cancelled = False;
+
+  def __lt__(self, o):
+    return (self.priority, self.seq) < (o.priority, o.seq);
+
+def _hashfile(job, tree, path, level):
+  """
+  Hash a file in a worker thread, stops between reads if the job is cancelled.
+  """
+  hasher = tree.hasher(level);
+
+  with open(path, "rb") as fp:
+    while True:
+      if job is not None and job.cancelled:
+        raise defer.CancelledError();
+
+      chunk = fp.read(READSIZE);
+
+      if not chunk:
+        break;
+
+      hasher.update(chunk);
+
+  if level is None:
+    return hasher.digest(), None;
+
+  return hasher.digest(), ''.join(hasher.levelhashes());
+
+def _processhashfile(tree, path, level):
+  return _hashfile(None, tree, path, level);
+
+class HashService(object):
+  """
+  Runs at most workers hash jobs at a time, in order of priority (HIGH, NORMAL,
+  LOW or any other number, lower first) and then submission. At most maxqueue
+  jobs wait, further jobs fail with QueueFull.
+
+  Every job returns a Deferred, cancelling it removes a waiting job from the
+  queue and stops a running file hash at the next read. With processes=True
+  jobs run in a multiprocessing pool, which hashes in parallel but can not
+  stop a running job, its result is discarded. stop cancels every waiting
+  and running job.
+  """
+  def __init__(self, tree=None, workers=2, maxqueue=1000, processes=False, reactor=None):
+    if tree is None:
+      from ..tth import TigerTree as tree;
+
+    if reactor is None:
+      from twisted.internet import reactor;
+
+    self.tree = tree;
+    self.workers = workers;
+    self.maxqueue = maxqueue;
+    self.processes = processes;
+    self.reactor = reactor;
+
+    self.pending = list();
+    self.running = 0;
+    self._active = set();
+    self._seq = itertools.count();
+    self._threads = None;
+    self._processes = None;
+
+  def start(self):
+    if self._threads is not None:
+      return;
+
+    self._threads = threadpool.ThreadPool(self.workers, self.workers, "adc-hashing");
+    self._threads.start();
+
+    if self.processes:
+      import multiprocessing;
+      self._processes = multiprocessing.Pool(self.workers);
+
+    self.reactor.addSystemEventTrigger("during", "shutdown", self.stop);
+
+  def stop(self):
+    """
+    Cancel every waiting and running job and stop the pools.
+
+    Running file hashes stop at their next read and process jobs are no
+    longer waited for, so the worker threads can be joined at once.
+    """
+    pending, self.pending = self.pending, list();
+
+    for job in pending + list(self._active):
+      job.cancelled = True;
+      job.deferred.cancel();
+
+    if self._processes is not None:
+      self._processes.terminate();
+      self._processes = None;
+
+    if self._threads is not None:
+      self._threads.stop();
+      self._threads = None;
+
+  def submit(self, f, args=(), priority=NORMAL):
+    """
+    Run f(job, *args) in a worker thread, job.cancelled tells if the job has
+    been cancelled. Returns a Deferred with the result.
+    """
+    if len(self.pending) >= self.maxqueue:
+      return defer.fail(QueueFull("hash queue is full: " + str(len(self.pending)) + " jobs"));
+
+    job = _Job(priority, self._seq.next(), f, args);
+    job.deferred = defer.Deferred(lambda d: self._cancel(job));
+
+    self.start();
+    heapq.heappush(self.pending, job);
+    self._next();
+    return job.deferred;
+
+  def hashfile(self, path, level=None, priority=NORMAL):
+    """
+    Deferred (root, leaves) of the file at path, leaves are the hashes of level or None.
+    """
+    if self.processes:
+      return self.submit(self._inprocess, (_processhashfile, (self.tree, path, level)), priority);
+
+    return self.submit(_hashfile, (self.tree, path, level), priority);
+
+  def tthl(self, path, blocksize=None, levels=None, priority=NORMAL):
+    """
+    Deferred (root, leaves) with the level requested by blocksize or levels, see MerkleTree.tthl.
+    """
+    import os;
+
+    depth = None;
+
+    if levels is not None:
+      depth = self.tree.depth(os.path.getsize(path));
+
+    return self.hashfile(path, self.tree.findlevel(depth, blocksize, levels), priority);
+
+  def _inprocess(self, job, f, args):
+    import multiprocessing;
+
+    result = self._processes.apply_async(f, args);
+
+    while True:
+      if job.cancelled:
+        raise defer.CancelledError();
+
+      try:
+        return result.get(PROCESS_POLL);
+      except multiprocessing.TimeoutError:
+        pass;
+
+  def _cancel(self, job):
+    job.cancelled = True;
+
+    if job in self.pending:
+      self.pending.remove(job);
+      heapq.heapify(self.pending);
+
+  def _next(self):
+    while self.running < self.workers and self.pending:
+      job = heapq.heappop(self.pending);
+      self.running += 1;
+      self._active.add(job);
+
+      d = threads.deferToThreadPool(self.reactor, self._threads, job.f, job, *job.args);
+      d.addBoth(self._done, job);
+
+  def _done(self, result, job):
+    self.running -= 1;
+    self._active.discard(job);
+
+    if not job.cancelled:
+      job.deferred.callback(result);
+
+    self._next();
@@ -1,5 +1,5 @@
-from ..types import encode, decode
-from ..types import *
+from ..arguments import encode, decode
+from ..arguments import *
 
 class ADCStatus:
     MESSAGES = {
@@ -138,6 +138,63 @@ class ADCInfo(dict):
     def clean(self):
         self.dirtykeys.clear();
 
+class LocalInfo(ADCInfo):
+    """
+    INF state of the local user on a single hub connection.
+    
+    Values are kept decoded and only marked dirty when they actually change,
+    full is used for the login INF and delta for every following update, each
+    returning the encoded fields to send and cleaning the dirty keys.
+    """
+    def __init__(self, sid=None, *args, **kw):
+        ADCInfo.__init__(self, sid, *args, **kw);
+        self.announced = False;
+    
+    def set(self, k, v):
+        """
+        Set a field, None removes it. Unlike setitem this can be called any
+        number of times between deltas.
+        """
+        if not self.exists(k):
+            raise ValueError("invalid info key: " + k);
+        
+        if v is None:
+            if dict.__contains__(self, k):
+                dict.__delitem__(self, k);
+                self.dirtykeys.add(k);
+            return;
+        
+        if dict.__contains__(self, k) and encode(dict.__getitem__(self, k)) == encode(v):
+            return;
+        
+        dict.__setitem__(self, k, v);
+        self.dirtykeys.add(k);
+    
+    def full(self):
+        """
+        All fields, encoded.
+        """
+        result = dict((k, encode(v)) for k, v in self.items());
+        self.announced = True;
+        self.clean();
+        return result;
+    
+    def delta(self):
+        """
+        Only the fields changed since the last full or delta, encoded; removed
+        fields are sent with an empty value.
+        """
+        result = dict();
+        
+        for k in self.dirtykeys:
+            if dict.__contains__(self, k):
+                result[k] = encode(dict.__getitem__(self, k));
+            else:
+                result[k] = "";
+        
+        self.clean();
+        return result;
+
 class ADCFeatures(set):
     FEATURES = [
         "TIGR",
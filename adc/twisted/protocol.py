@@ -1,17 +1,102 @@
 from twisted.protocols.basic import LineReceiver
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 
+import collections
 import logging
+import zlib
 
-from ..parser import ADCParser
-from ..types import *
-from ..types import decode
+from ..message import Message, LazyMessage
+from ..arguments import *
+from ..arguments import decode, DECODERS
 from ..logger import Logger
 
+@implementer(IPushProducer)
+class _OutputProducer(object):
+    """
+    Registered with the transport for the output queue of an ADCProtocol, the
+    protocol's own pauseProducing and resumeProducing still pause reading.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol;
+    
+    def pauseProducing(self):
+        self.protocol.pauseOutput();
+    
+    def resumeProducing(self):
+        self.protocol.resumeOutput();
+    
+    def stopProducing(self):
+        self.protocol.stopOutput();
+
 class ADCProtocol(LineReceiver):
     delimiter = '\n'
     
+    """
+    Name of the parser backend used for incoming frames, see adc.parser.PARSERS.
+    """
+    frameparser = "fast";
+    
+    """
+    Only parse the header of incoming frames, parameters are decoded when a handler accesses them.
+    Lazy frames are parsed by the fast backend, other frameparsers always parse whole frames.
+    """
+    lazyframes = True;
+    
+    """
+    Buffer outgoing frames and write them with a single writeSequence, once
+    per reactor iteration or when flushsize bytes are buffered, see flush.
+    """
+    coalesce = False;
+    flushsize = 64 * 1024;
+    
+    """
+    The output queue is registered as a streaming producer with the transport
+    (see registerOutput), while the transport is full outgoing frames are
+    queued. When more than highwater
+    bytes are queued, the overflow policy applies until the queue is back under
+    lowwater:
+    
+      "pause"       stop reading from the peer.
+      "drop"        drop frames sent as droppable (e.g. chat).
+      "disconnect"  drop the queue and abort the connection.
+    
+    Whatever the policy, the connection is aborted once more than maxoutput
+    bytes are queued, which bounds the memory used by a slow peer.
+    """
+    highwater = 1024 * 1024;
+    lowwater = 256 * 1024;
+    maxoutput = 4 * 1024 * 1024;
+    overflow = "pause";
+    
+    OVERFLOW_POLICIES = ("pause", "drop", "disconnect");
+    
+    """
+    Largest number of bytes inflated at a time from a compressed stream (ZLIF).
+    """
+    inflatesize = 64 * 1024;
+    
     def __init__(self, **kw):
         self.log = kw.get("logger", Logger(ADCProtocol, "n/a"));
+        self.frameparser = kw.get("frameparser", self.frameparser);
+        self.lazyframes = kw.get("lazyframes", self.lazyframes);
+        self.coalesce = kw.get("coalesce", self.coalesce);
+        self.flushsize = kw.get("flushsize", self.flushsize);
+        self.inflatesize = kw.get("inflatesize", self.inflatesize);
+        self.reactor = kw.get("reactor", None);
+        self.highwater = kw.get("highwater", self.highwater);
+        self.lowwater = kw.get("lowwater", self.lowwater);
+        self.maxoutput = kw.get("maxoutput", self.maxoutput);
+        self.overflow = kw.get("overflow", self.overflow);
+        
+        if self.overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("not a valid overflow policy: " + repr(self.overflow));
+        
+        if self.lowwater > self.highwater:
+            raise ValueError("lowwater must not be greater than highwater");
+        
+        if self.maxoutput < self.highwater:
+            raise ValueError("maxoutput must not be less than highwater");
         
         if self.context is None:
             raise ValueError("the static field 'context' must be set in the ADCProtocol");
@@ -19,10 +104,24 @@ class ADCProtocol(LineReceiver):
         if self.signals is None:
             raise ValueError("the static field 'signals' must be set in the ADCProtocol");
         
+        self.context.compile();
+        
         self.prefix = "n/a";
         self.connected = False;
         self.__state = None;
+        self.__handlers = self.context.table(None);
         self.__signalhandlers = dict();
+        self.__output = collections.deque();
+        self.__outputsize = 0;
+        self.__flushcall = None;
+        self.__inflater = None;
+        self.__compressed = "";
+        self.__deflater = None;
+        self.__blocked = False;
+        self.__overflowing = False;
+        self.__discarding = False;
+        self.__producer = None;
+        self.dropped = 0;
     
     def connect(self, handle, callback):
         if handle not in self.signals:
@@ -45,51 +144,369 @@ class ADCProtocol(LineReceiver):
         Set the state of the current connection.
         This will affect how the next state is picked.
         """
-        self.log.msg("setState:", state, logLevel=logging.DEBUG);
+        if self.log.enabled(logging.DEBUG):
+            self.log.msg("setState:", state, logLevel=logging.DEBUG);
+        
         self.__state = state;
+        self.__handlers = self.context.table(state);
+    
+    def sendFrame(self, frame, flush=False, droppable=False):
+        self.sendEncoded(str(frame), flush, droppable);
     
-    def sendFrame(self, frame):
-        sf = str(frame);
-        self.log.msg("sendFrame:", sf, logLevel=logging.DEBUG)
-        self.sendLine(sf);
+    def sendEncoded(self, data, flush=False, droppable=False):
+        """
+        Send a frame which has already been encoded, see Message.encode.
+        
+        When coalescing, flush writes this and every buffered frame immediately.
+        A droppable frame is discarded instead of queued under the "drop" policy.
+        """
+        if self.log.enabled(logging.DEBUG):
+            self.log.msg("sendFrame:", data, logLevel=logging.DEBUG)
+        
+        # the connection is aborted or lost, nothing will be written anymore.
+        if self.__discarding:
+            return;
+        
+        if droppable and self.__overflowing and self.overflow == "drop":
+            self.dropped += 1;
+            return;
+        
+        if not self.coalesce and not self.__blocked:
+            self.__write([data, self.delimiter]);
+            return;
+        
+        self.__output.append(data);
+        self.__output.append(self.delimiter);
+        self.__outputsize += len(data) + len(self.delimiter);
+        
+        if self.__blocked:
+            if self.__outputsize > self.maxoutput:
+                self.log.msg("output queue over maxoutput:", self.__outputsize, "bytes, aborting", logLevel=logging.WARN);
+                self.__abort();
+            elif self.__outputsize > self.highwater:
+                self.__overflow();
+            return;
+        
+        if flush or self.__outputsize >= self.flushsize:
+            self.flush();
+        elif self.__flushcall is None:
+            if self.reactor is None:
+                from twisted.internet import reactor;
+                self.reactor = reactor;
+            
+            self.__flushcall = self.reactor.callLater(0, self.flush);
+    
+    def flush(self):
+        """
+        Write buffered frames, flushsize bytes at a time until the transport is full.
+        """
+        if self.__flushcall is not None:
+            if self.__flushcall.active():
+                self.__flushcall.cancel();
+            
+            self.__flushcall = None;
+        
+        output = self.__output;
+        
+        # the transport calls pauseProducing from write once its buffer is full.
+        while output and not self.__blocked:
+            chunk = list();
+            size = 0;
+            
+            # frames are queued as (data, delimiter) pairs.
+            while output and size < self.flushsize:
+                data = output.popleft();
+                delimiter = output.popleft();
+                chunk.append(data);
+                chunk.append(delimiter);
+                size += len(data) + len(delimiter);
+            
+            self.__outputsize -= size;
+            self.__write(chunk);
+        
+        if self.__overflowing and self.__outputsize <= self.lowwater:
+            self.__drained();
+    
+    def __writeall(self):
+        """
+        Write every queued frame even if the transport is full.
+        """
+        if self.__output:
+            output = list(self.__output);
+            self.__output.clear();
+            self.__outputsize = 0;
+            self.__write(output);
+        
+        if self.__overflowing:
+            self.__drained();
+    
+    def __overflow(self):
+        if self.__overflowing:
+            return;
+        
+        self.__overflowing = True;
+        self.log.msg("output queue over highwater:", self.__outputsize, "bytes, policy:", self.overflow, logLevel=logging.WARN);
+        
+        if self.overflow == "pause":
+            self.pauseProducing();
+        elif self.overflow == "disconnect":
+            self.__abort();
+    
+    def __abort(self):
+        """
+        Drop the queue and every frame sent from now on, and abort the connection.
+        """
+        self.__discarding = True;
+        self.__overflowing = False;
+        self.__output.clear();
+        self.__outputsize = 0;
+        
+        if hasattr(self.transport, "abortConnection"):
+            self.transport.abortConnection();
+        else:
+            self.loseConnection();
+    
+    def __drained(self):
+        self.__overflowing = False;
+        
+        if self.overflow == "pause" and self.connected:
+            self.resumeProducing();
+    
+    def registerOutput(self):
+        """
+        Register the output queue as a streaming producer with the transport,
+        done by connectionMade.
+        """
+        if self.__producer is not None:
+            return;
+        
+        self.__producer = _OutputProducer(self);
+        self.transport.registerProducer(self.__producer, True);
+    
+    def unregisterOutput(self):
+        """
+        Write every queued frame and unregister the output queue from the
+        transport, so that another producer (e.g. a FileSender in the DATA
+        state) can be registered. Call registerOutput once it is done.
+        """
+        if self.__producer is None:
+            return;
+        
+        self.__producer = None;
+        self.__blocked = False;
+        self.__writeall();
+        self.transport.unregisterProducer();
+    
+    def loseConnection(self):
+        """
+        Close the connection once every queued frame is written.
+        
+        The transport does not close while a paused producer is registered,
+        so the output queue is unregistered first.
+        """
+        self.unregisterOutput();
+        self.transport.loseConnection();
+    
+    def pauseOutput(self):
+        """
+        Called through the output producer when the transport's write buffer is full.
+        """
+        self.__blocked = True;
+    
+    def resumeOutput(self):
+        """
+        Called through the output producer when the transport's write buffer has been written.
+        """
+        self.__blocked = False;
+        self.flush();
+    
+    def stopOutput(self):
+        """
+        Called through the output producer when the connection is closed, the queue is dropped.
+        """
+        self.__blocked = True;
+        self.__output.clear();
+        self.__outputsize = 0;
+    
+    def __write(self, data):
+        if self.__deflater is None:
+            self.transport.writeSequence(data);
+            return;
+        
+        # every write is flushed, so the peer can inflate whole frames.
+        deflater = self.__deflater;
+        self.transport.write(deflater.compress(''.join(data)) + deflater.flush(zlib.Z_SYNC_FLUSH));
+    
+    def startDeflate(self, frame):
+        """
+        Send frame (e.g. a ZON) uncompressed and compress everything sent after it, see ZLIF.
+        """
+        self.sendFrame(frame, flush=True);
+        # frames queued while the transport is full were sent before frame.
+        self.__writeall();
+        self.__deflater = zlib.compressobj();
+    
+    def stopDeflate(self):
+        """
+        End the compressed stream, everything sent after it is uncompressed.
+        """
+        if self.__deflater is None:
+            return;
+        
+        self.__writeall();
+        deflater, self.__deflater = self.__deflater, None;
+        self.transport.write(deflater.flush(zlib.Z_FINISH));
+    
+    def startInflate(self):
+        """
+        Inflate everything received after the current line until the end of
+        the zlib stream, call from the handler of a ZON frame.
+        """
+        self.__inflater = zlib.decompressobj();
+        # the rest of the buffered data is compressed, it is passed to rawDataReceived.
+        self.setRawMode();
+    
+    def rawDataReceived(self, data):
+        """
+        Only used by startInflate, receives the compressed data buffered after
+        the current line, which is inflated once the line splitter returns.
+        """
+        self.setLineMode();
+        self.__compressed += data;
+    
+    def dataReceived(self, data):
+        if self.__inflater is None:
+            why = LineReceiver.dataReceived(self, data);
+            
+            # a ZON handler may have started a compressed stream.
+            if why or self.__inflater is None:
+                return why;
+            
+            data = "";
+        
+        return self.__inflateReceived(data);
+    
+    def __inflateReceived(self, data):
+        """
+        Inflate at most inflatesize bytes at a time and pass them to the line
+        splitter, the rest waits while reading is paused.
+        """
+        # startInflate was called outside of lineReceived, nothing was buffered.
+        if not self.line_mode:
+            self.setLineMode();
+        
+        self.__compressed += data;
+        
+        # lines buffered while paused go first.
+        why = LineReceiver.dataReceived(self, "");
+        
+        while not why and self.__inflater is not None and self.__compressed and not self.paused:
+            inflater = self.__inflater;
+            data = inflater.decompress(self.__compressed, self.inflatesize);
+            self.__compressed = inflater.unconsumed_tail;
+            rest = None;
+            
+            # data after the end of the zlib stream is not compressed.
+            if inflater.unused_data:
+                rest = inflater.unused_data;
+                self.__inflater = None;
+                self.__compressed = "";
+            
+            why = LineReceiver.dataReceived(self, data);
+            
+            if not why and rest is not None:
+                why = LineReceiver.dataReceived(self, rest);
+        
+        return why;
     
     def connectionMade(self):
         """
         This is the entry for client-client connections.
         """
         self.connected = True;
+        self.registerOutput();
         self.context.runinitial(self);
     
     def connectionLost(self, reason):
         self.connected = False;
+        
+        if self.__flushcall is not None and self.__flushcall.active():
+            self.__flushcall.cancel();
+        
+        self.__flushcall = None;
+        self.__output.clear();
+        self.__outputsize = 0;
+        self.__overflowing = False;
+        self.__discarding = True;
         self.log.msg(reason.value);
     
     def lineReceived(self, line):
         """
         Receive a line, and transform it into a frame.
         """
-        self.log.msg("lineReceived:", line, logLevel=logging.DEBUG)
+        if self.log.enabled(logging.DEBUG):
+            self.log.msg("lineReceived:", line, logLevel=logging.DEBUG)
         
         try:
-            frame = ADCParser.parseString(line);
+            if self.lazyframes and self.frameparser == "fast":
+                frame = LazyMessage.parse(line);
+            else:
+                frame = Message.parse(line, self.frameparser);
         except Exception, e:
             import traceback
             self.log.err();
-            self.transport.loseConnection();
+            self.loseConnection();
             return;
         
         if not frame.header:
             return;
         
-        if not self.context.hasmethod(self.__state, frame.header.__class__, frame.header.cmd):
-            self.log.msg("unhandled: @context(context." + self.__state + ", " + str(frame.header.__class__) + ", '" + frame.header.cmd + "')", logLevel=logging.WARN);
+        handler = self.__handlers.get((frame.header.__class__, frame.header.cmd), None);
+        
+        if handler is None:
+            self.log.msg("unhandled: @context(context." + str(self.__state) + ", " + str(frame.header.__class__) + ", '" + frame.header.cmd + "')", logLevel=logging.WARN);
             return;
         
         try:
-            self.context.callmethod(self.__state, frame.header.__class__, frame.header.cmd, self, frame);
+            handler(self, frame);
         except:
             self.log.err();
-            self.transport.loseConnection();
+            self.loseConnection();
+
+def sendFrameAll(protocols, frame, droppable=False):
+    """
+    Fan out a single frame to many connections, it is only serialized once.
+    """
+    data = str(frame);
+    
+    for protocol in protocols:
+        protocol.sendEncoded(data, droppable=droppable);
+
+_EMPTY_TABLE = dict();
+
+def _decoder(t):
+    """
+    The decoder and extra decoder arguments for a parameter type, which is a type tag or a (tag, args...) tuple.
+    """
+    if type(t) == tuple:
+        t, extra = t[0], t[1:];
+    else:
+        extra = ();
+    
+    if t not in DECODERS:
+        raise ValueError("cannot decode type: " + repr(t));
+    
+    return DECODERS[t], extra;
+
+def _chain(cbs):
+    """
+    A single handler calling every handler registered for the same state, header and command.
+    """
+    def handler(kself, *args, **kw):
+        for cb in cbs:
+            cb(kself, *args, **kw);
+    
+    return handler;
 
 class ADCContext:
     INITIAL="INITIAL";
@@ -105,6 +522,7 @@ class ADCContext:
         self.name = name;
         self.states = dict();
         self.initial = list();
+        self.tables = None;
 
     def runinitial(self, kself, *args, **kw):
         for init in self.initial:
@@ -118,44 +536,72 @@ class ADCContext:
             self.states[(state, header, command)] = list();
         
         self.states[(state, header, command)].append(cb);
+        self.tables = None;
     
     def addinitialmethod(self, cb):
         self.initial.append(cb);
     
     def hasmethod(self, state, header, command):
-        if (state, header, command) in self.states:
-            return True;
+        return (header, command) in self.table(state);
+    
+    def compile(self):
+        """
+        Build the dispatch table of every state, a dict from (header class, command)
+        to a single handler. Tables are rebuilt when a method is added.
+        """
+        if self.tables is not None:
+            return;
         
-        return False;
+        tables = dict();
+        
+        for (state, header, command), cbs in self.states.items():
+            if len(cbs) == 1:
+                handler = cbs[0];
+            else:
+                handler = _chain(tuple(cbs));
+            
+            tables.setdefault(state, dict())[(header, command)] = handler;
+        
+        self.tables = tables;
+    
+    def table(self, state):
+        """
+        The dispatch table of state, see compile.
+        """
+        self.compile();
+        return self.tables.get(state, _EMPTY_TABLE);
     
     def params(self, *required_args, **required_kw):
         """
         bind the helper method params to the wrapper
+        
+        The decoders for every parameter are looked up once, here.
         """
+        positional = [(i,) + _decoder(t) for i, t in enumerate(required_args)];
+        named = [(k, isinstance(t, List)) + _decoder(isinstance(t, List) and t.type or t) for k, t in required_kw.items()];
         
         def wrapper(f):
             def cb(self, frame):
                 args = list();
                 kw = dict();
                 
-                for i, t in enumerate(required_args):
+                for i, decoder, extra in positional:
                     rval = frame.get(i);
                     if rval is None: raise ValueError("missing required positional argument: " + str(i));
-                    if type(t) == tuple: args.append(decode(rval, *t));
-                    else: args.append(decode(rval, t));
+                    args.append(decoder(rval, *extra));
                 
-                for k, t in required_kw.items():
+                for k, many, decoder, extra in named:
                     plist = frame.get(k)
 
-                    if isinstance(t, List):
-                        kw[k] = [decode(v, t.type) for v in plist];
+                    if many:
+                        kw[k] = [decoder(v, *extra) for v in plist];
+                    elif plist:
+                        kw[k] = decoder(plist[0], *extra);
                     else:
-                        kw[k] = [decode(v, t) for v in plist];
-                        
-                        if len(kw[k]) > 0:
-                            kw[k] = kw[k][0];
-                        else:
-                            kw[k] = None;
+                        kw[k] = None;
+                
+                if not self.log.enabled(logging.DEBUG):
+                    return f(self, frame, *args, **kw);
                 
                 self.log.msg("entering:", f.func_name, repr(args), repr(kw), logLevel=logging.DEBUG);
                 try:
@@ -167,11 +613,12 @@ class ADCContext:
         return wrapper;
     
     def callmethod(self, state, header, command, kself, *args, **kw):
-        if not self.hasmethod(state, header, command):
-            raise ValueError("not a valid method for context '" + self.name + "': " + state + " " + str(header) + " " + command);
+        handler = self.table(state).get((header, command), None);
         
-        for cb in self.states[(state, header, command)]:
-            cb(kself, *args, **kw);
+        if handler is None:
+            raise ValueError("not a valid method for context '" + self.name + "': " + str(state) + " " + str(header) + " " + command);
+        
+        handler(kself, *args, **kw);
 
     def __call__(self, state, header=None, command=None):
         if state == self.INITIAL:
@@ -192,5 +639,7 @@ class ADCContext:
                 return f(*args, **kw);
         
             self.addmethod(state, header, command, cb);
+            # returned so that a handler can be registered for more than one state.
+            return cb;
         
         return wrapper;
@@ -20,7 +20,6 @@ setup(name='adc',
       install_requires=[
           # -*- Extra requirements: -*-
           "pyparsing",
-          "ipy",
           "python-mhash"
       ],
       test_suite='tests',
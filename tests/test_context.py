@@ -0,0 +1,415 @@
+import unittest
+import logging
+import zlib
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet import abstract, main
+from twisted.internet.task import Clock
+from twisted.python import failure
+
+from adc.arguments import *
+from adc.message import *
+from adc.logger import Logger
+from adc.twisted.protocol import ADCProtocol, ADCContext
+
+class EchoProtocol(ADCProtocol):
+  context = ADCContext("Test");
+  signals = set();
+
+  def __init__(self, **kw):
+    kw["logger"] = Logger(EchoProtocol);
+    kw["logger"].setLogLevel(logging.CRITICAL);
+    ADCProtocol.__init__(self, **kw);
+    self.calls = list();
+    self.pauseafter = None;
+
+  @context(context.INITIAL)
+  def do_initial(self):
+    self.setState(self.context.PROTOCOL);
+
+  @context(context.PROTOCOL, Info, 'SUP')
+  @context.params(AD=List(STR), SS=INT)
+  def do_sup(self, frame, AD, SS):
+    self.calls.append(("sup", AD, SS));
+    self.setState(self.context.NORMAL);
+
+  @context(context.NORMAL, Broadcast, 'MSG')
+  @context.params(STR, (B32, 6), PM=STR)
+  def do_msg(self, frame, text, b32, PM):
+    self.calls.append(("msg", text, b32.val, PM));
+
+  @context(context.NORMAL, Broadcast, 'MSG')
+  def do_msg_again(self, frame):
+    self.calls.append(("again", frame.header.my_sid));
+    self.lastframe = frame;
+
+    if self.pauseafter is not None and len(self.calls) >= self.pauseafter:
+      self.pauseProducing();
+
+  @context(context.NORMAL, Info, 'ZON')
+  def do_zon(self, frame):
+    self.startInflate();
+
+class TestContext(unittest.TestCase):
+  def setUp(self):
+    self.protocol = EchoProtocol();
+    self.protocol.makeConnection(StringTransport());
+
+  def test_dispatch(self):
+    self.protocol.lineReceived("BMSG AAAA foo IZHU6QSBKI");
+    self.assertEqual(self.protocol.calls, []);
+
+    self.protocol.lineReceived("ISUP ADBASE ADTIGR SS10");
+    self.protocol.lineReceived("ISUP ADBASE");
+    self.protocol.lineReceived("BMSG AAAA foo\\sbar IZHU6QSBKI");
+    self.protocol.lineReceived("BMSG BBBB foo IZHU6QSBKI PMCCCC");
+
+    self.assertEqual(self.protocol.calls, [
+      ("sup", ["BASE", "TIGR"], 10),
+      ("msg", "foo bar", "FOOBAR", None),
+      ("again", "AAAA"),
+      ("msg", "foo", "FOOBAR", "CCCC"),
+      ("again", "BBBB"),
+    ]);
+
+  def test_tables(self):
+    context = EchoProtocol.context;
+    self.assertTrue(context.hasmethod(context.NORMAL, Broadcast, 'MSG'));
+    self.assertFalse(context.hasmethod(context.PROTOCOL, Broadcast, 'MSG'));
+    self.assertFalse(context.hasmethod(None, Broadcast, 'MSG'));
+    self.assertEqual(set(context.table(context.NORMAL).keys()), set([(Broadcast, 'MSG'), (Info, 'ZON')]));
+
+  def test_frameparser(self):
+    for frameparser, lazyframes, klass in [("fast", True, LazyMessage), ("fast", False, Message), ("pyparsing", True, Message)]:
+      protocol = EchoProtocol(frameparser=frameparser, lazyframes=lazyframes);
+      protocol.makeConnection(StringTransport());
+      protocol.setState(protocol.context.NORMAL);
+      protocol.dataReceived("BMSG AAAA foo IZHU6QSBKI PMbar\n");
+      self.assertEqual(protocol.calls[-1], ("again", "AAAA"));
+      self.assertEqual(protocol.lastframe.__class__, klass, (frameparser, lazyframes));
+
+  def test_invalid_parameters(self):
+    self.protocol.lineReceived("ISUP SSfoo");
+    self.assertTrue(self.protocol.transport.disconnecting);
+
+  def test_unknown_type(self):
+    self.assertRaises(ValueError, EchoProtocol.context.params, "FOO");
+
+class CountingTransport(StringTransport):
+  def __init__(self):
+    StringTransport.__init__(self);
+    self.writes = 0;
+
+  def writeSequence(self, data):
+    self.writes += 1;
+    StringTransport.writeSequence(self, data);
+
+class TestCoalescing(unittest.TestCase):
+  def setUp(self):
+    self.clock = Clock();
+    self.protocol = EchoProtocol(coalesce=True, flushsize=100, reactor=self.clock);
+    self.transport = CountingTransport();
+    self.protocol.makeConnection(self.transport);
+
+  def test_once_per_iteration(self):
+    for i in range(3):
+      self.protocol.sendEncoded("BMSG AAAA " + str(i));
+
+    self.assertEqual(self.transport.writes, 0);
+    self.clock.advance(0);
+    self.assertEqual(self.transport.writes, 1);
+    self.assertEqual(self.transport.value(), "BMSG AAAA 0\nBMSG AAAA 1\nBMSG AAAA 2\n");
+
+    self.clock.advance(0);
+    self.assertEqual(self.transport.writes, 1);
+
+  def test_threshold(self):
+    for i in range(10):
+      self.protocol.sendEncoded("BMSG AAAA " + "x" * 30);
+
+    self.assertEqual(self.transport.writes, 3);
+    self.clock.advance(0);
+    self.assertEqual(self.transport.writes, 4);
+    self.assertEqual(len(self.transport.value()), 10 * 41);
+
+  def test_explicit_flush(self):
+    self.protocol.sendEncoded("BMSG AAAA foo");
+    self.protocol.sendFrame(Message(Broadcast(my_sid="AAAA", cmd='MSG'), "bar"), flush=True);
+    self.assertEqual(self.transport.writes, 1);
+    self.assertEqual(self.transport.value(), "BMSG AAAA foo\nBMSG AAAA bar\n");
+    self.assertEqual(self.clock.getDelayedCalls(), []);
+
+  def test_connection_lost(self):
+    self.protocol.sendEncoded("BMSG AAAA foo");
+    self.protocol.connectionLost(failure.Failure(Exception("lost")));
+    self.assertEqual(self.clock.getDelayedCalls(), []);
+    self.protocol.flush();
+    self.assertEqual(self.transport.writes, 0);
+
+  def test_disabled(self):
+    protocol = EchoProtocol(reactor=self.clock);
+    transport = CountingTransport();
+    protocol.makeConnection(transport);
+    protocol.sendEncoded("BMSG AAAA foo");
+    self.assertEqual(transport.writes, 1);
+
+class TestCompression(unittest.TestCase):
+  def setUp(self):
+    self.protocol = EchoProtocol();
+    self.transport = StringTransport();
+    self.protocol.makeConnection(self.transport);
+
+  def sids(self):
+    return [c[1] for c in self.protocol.calls if c[0] == "again"];
+
+  def test_inflate(self):
+    frames = "".join("BMSG " + sid + " foo IZHU6QSBKI\n" for sid in ["BBBB", "CCCC", "DDDD"]);
+    data = "ISUP ADBASE\nBMSG AAAA foo IZHU6QSBKI\nIZON\n" + zlib.compress(frames) + "BMSG EEEE foo IZHU6QSBKI\n";
+
+    for size in [1, 7, 100, len(data)]:
+      self.setUp();
+
+      for i in range(0, len(data), size):
+        self.protocol.dataReceived(data[i:i+size]);
+
+      self.assertEqual(self.sids(), ["AAAA", "BBBB", "CCCC", "DDDD", "EEEE"], size);
+
+  def test_inflate_outside_of_line(self):
+    self.protocol.dataReceived("ISUP ADBASE\n");
+    self.protocol.startInflate();
+    self.protocol.dataReceived(zlib.compress("BMSG BBBB foo IZHU6QSBKI\n"));
+    self.protocol.dataReceived("BMSG CCCC foo IZHU6QSBKI\n");
+    self.assertEqual(self.sids(), ["BBBB", "CCCC"]);
+
+  def test_inflate_bounded(self):
+    count = 20000;
+    frames = "BMSG BBBB foo IZHU6QSBKI\n" * count;
+    data = "ISUP ADBASE\nIZON\n" + zlib.compress(frames) + "BMSG EEEE foo IZHU6QSBKI\n";
+
+    self.protocol = EchoProtocol(inflatesize=1024);
+    self.protocol.makeConnection(StringTransport());
+    self.protocol.pauseafter = 1;
+    self.protocol.dataReceived(data);
+
+    # only one step was inflated, the rest waits until reading is resumed.
+    self.assertEqual(len(self.sids()), 1);
+    self.assertTrue(len(self.protocol._buffer) <= 1024);
+
+    self.protocol.pauseafter = None;
+    self.protocol.resumeProducing();
+    self.assertEqual(self.sids(), ["BBBB"] * count + ["EEEE"]);
+
+  def test_deflate(self):
+    self.protocol.startDeflate(Message(Hub(cmd='ZON')));
+    self.protocol.sendEncoded("BMSG AAAA foo");
+    self.protocol.sendEncoded("BMSG AAAA bar");
+
+    plain, compressed = self.transport.value().split("\n", 1);
+    self.assertEqual(plain, "HZON");
+
+    inflater = zlib.decompressobj();
+    self.assertEqual(inflater.decompress(compressed), "BMSG AAAA foo\nBMSG AAAA bar\n");
+
+    self.protocol.stopDeflate();
+    self.protocol.sendEncoded("BMSG AAAA baz");
+    rest = self.transport.value()[len(plain) + 1 + len(compressed):];
+    self.assertEqual(inflater.decompress(rest), "");
+    self.assertEqual(inflater.unused_data, "BMSG AAAA baz\n");
+
+class FDReactor(object):
+  def __init__(self):
+    self.readers = set();
+    self.writers = set();
+
+  def addReader(self, r): self.readers.add(r);
+  def removeReader(self, r): self.readers.discard(r);
+  def addWriter(self, w): self.writers.add(w);
+  def removeWriter(self, w): self.writers.discard(w);
+
+class SlowTransport(abstract.FileDescriptor):
+  """
+  A FileDescriptor whose peer accepts accept bytes per doWrite, with the
+  producer and close handling of a real TCP transport.
+  """
+  bufferSize = 64;
+
+  def __init__(self):
+    abstract.FileDescriptor.__init__(self, FDReactor());
+    self.connected = 1;
+    self.accept = 0;
+    self.written = list();
+
+  def writeSomeData(self, data):
+    n = min(self.accept, len(data));
+    self.written.append(str(data[:n]));
+    return n;
+
+  def run(self):
+    """
+    Call doWrite while the reactor would, returns the reason the connection was lost or None.
+    """
+    while self in self.reactor.writers:
+      result = self.doWrite();
+
+      if result is not None:
+        return result;
+
+    return None;
+
+class TestBackpressure(unittest.TestCase):
+  def connect(self, **kw):
+    self.protocol = EchoProtocol(highwater=100, lowwater=50, **kw);
+    self.transport = StringTransport();
+    self.protocol.makeConnection(self.transport);
+
+  def send(self, count, droppable=False):
+    for i in range(count):
+      self.protocol.sendEncoded("BMSG AAAA " + "x" * 10, droppable=droppable);
+
+  def test_registered(self):
+    self.connect();
+    self.assertTrue(self.transport.producer is not None);
+    self.assertTrue(self.transport.producer is not self.protocol);
+    self.assertTrue(self.transport.streaming);
+
+    # the protocol's own pauseProducing still pauses reading.
+    self.protocol.pauseProducing();
+    self.assertEqual(self.transport.producerState, "paused");
+    self.send(1);
+    self.assertEqual(self.transport.value(), "BMSG AAAA xxxxxxxxxx\n");
+
+  def test_file_sender(self):
+    from StringIO import StringIO
+    from twisted.protocols.basic import FileSender
+
+    self.connect();
+    self.transport.producer.pauseProducing();
+    self.send(1);
+
+    self.protocol.unregisterOutput();
+    self.assertEqual(self.transport.producer, None);
+    self.assertEqual(self.transport.value(), "BMSG AAAA xxxxxxxxxx\n");
+
+    sender = FileSender();
+    sender.beginFileTransfer(StringIO("data"), self.transport);
+    sender.resumeProducing();
+    sender.resumeProducing();
+    self.assertEqual(self.transport.producer, None);
+    self.assertTrue(self.transport.value().endswith("data"));
+
+    self.protocol.registerOutput();
+    self.assertTrue(self.transport.producer is not None);
+
+  def test_queued_while_paused(self):
+    self.connect();
+    self.transport.producer.pauseProducing();
+    self.send(3);
+    self.assertEqual(self.transport.value(), "");
+
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.value(), "BMSG AAAA xxxxxxxxxx\n" * 3);
+
+  def test_resumed_transport_paused_again(self):
+    self.connect(flushsize=42);
+    self.transport.producer.pauseProducing();
+    self.send(4);
+
+    # the transport calls pauseProducing from write when its buffer is full.
+    self.transport.write = lambda data: self.transport.producer.pauseProducing();
+    self.transport.writeSequence = lambda seq: self.transport.producer.pauseProducing();
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.value(), "");
+
+    del self.transport.write, self.transport.writeSequence;
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.value(), "BMSG AAAA xxxxxxxxxx\n" * 2);
+
+  def test_pause(self):
+    self.connect(overflow="pause");
+    self.transport.producer.pauseProducing();
+    self.send(4);
+    self.assertEqual(self.transport.producerState, "producing");
+
+    self.send(1);
+    self.assertEqual(self.transport.producerState, "paused");
+    self.protocol.dataReceived("ISUP ADBASE\n");
+    self.assertEqual(self.protocol.calls, []);
+
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.producerState, "producing");
+    self.assertEqual(self.protocol.calls, [("sup", ["BASE"], None)]);
+
+  def test_drop(self):
+    self.connect(overflow="drop");
+    self.transport.producer.pauseProducing();
+    self.send(5);
+    self.send(2, droppable=True);
+    self.protocol.sendEncoded("IQUI AAAA", droppable=False);
+    self.assertEqual(self.protocol.dropped, 2);
+
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.value(), "BMSG AAAA xxxxxxxxxx\n" * 5 + "IQUI AAAA\n");
+
+    self.send(1, droppable=True);
+    self.assertEqual(self.protocol.dropped, 2);
+
+  def test_disconnect(self):
+    self.connect(overflow="disconnect");
+    self.transport.producer.pauseProducing();
+    self.send(5);
+    self.assertTrue(self.transport.disconnecting);
+
+    # frames sent until connectionLost are not queued.
+    self.send(100);
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.value(), "");
+
+  def test_maxoutput(self):
+    for overflow in EchoProtocol.OVERFLOW_POLICIES:
+      self.connect(overflow=overflow, maxoutput=200);
+      self.transport.producer.pauseProducing();
+      self.send(9);
+      self.assertEqual(self.transport.disconnecting, overflow == "disconnect", overflow);
+
+      self.send(1);
+      self.assertTrue(self.transport.disconnecting, overflow);
+
+      self.send(100);
+      self.transport.producer.resumeProducing();
+      self.assertEqual(self.transport.value(), "", overflow);
+
+  def test_connection_lost(self):
+    self.connect();
+    self.transport.producer.pauseProducing();
+    self.protocol.connectionLost(failure.Failure(Exception("lost")));
+    self.send(100);
+    self.transport.producer.resumeProducing();
+    self.assertEqual(self.transport.value(), "");
+
+  def test_lose_connection_slow_peer(self):
+    big = "BMSG AAAA " + "x" * 100;
+
+    # with and without frames left in the protocol's own queue.
+    for frames in [[big], [big, "BMSG AAAA queued"]]:
+      protocol = EchoProtocol();
+      transport = SlowTransport();
+      protocol.makeConnection(transport);
+
+      # the first frame fills the transport's buffer, which pauses the output producer.
+      for frame in frames:
+        protocol.sendEncoded(frame);
+
+      self.assertTrue(transport.producerPaused);
+
+      protocol.loseConnection();
+      transport.accept = 1000;
+      self.assertTrue(transport.run() is main.CONNECTION_DONE, frames);
+      self.assertEqual("".join(transport.written), "".join(f + "\n" for f in frames));
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, EchoProtocol, overflow="ignore");
+    self.assertRaises(ValueError, EchoProtocol, highwater=10, lowwater=20);
+    self.assertRaises(ValueError, EchoProtocol, highwater=10, lowwater=5, maxoutput=5);
+
+if __name__ == "__main__":
+  unittest.main()
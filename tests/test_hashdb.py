@@ -0,0 +1,71 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from adc.hashdb import *
+
+from tests.test_merkletree import ShaTree
+
+class TestHashDatabase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp();
+    self.db = HashDatabase(os.path.join(self.dir, "hashes.db"), ShaTree, 2);
+
+  def tearDown(self):
+    self.db.close();
+    shutil.rmtree(self.dir);
+
+  def write(self, name, data, mtime=1000):
+    path = os.path.join(self.dir, name);
+
+    with open(path, "wb") as fp:
+      fp.write(data);
+
+    os.utime(path, (mtime, mtime));
+    return path;
+
+  def test_hash(self):
+    path = self.write("a", "A" * 100);
+    e = self.db.hash(path);
+    self.assertEqual(e.root, ShaTree("A" * 100).digest());
+    self.assertEqual(e.leaves, ShaTree("A" * 100).levels[2]);
+    self.assertEqual(self.db.lookup(path), e);
+    self.assertEqual(self.db.hash(os.path.join(self.dir, "missing")), None);
+
+  def test_incremental(self):
+    paths = [self.write(str(i), str(i) * 50) for i in range(10)];
+    self.assertEqual([hashed for p, e, hashed in self.db.update(paths)], [True] * 10);
+    self.assertEqual([hashed for p, e, hashed in self.db.update(paths)], [False] * 10);
+
+    self.write("3", "changed", 2000);
+    result = list(self.db.update(paths));
+    self.assertEqual([p for p, e, hashed in result], paths);
+    self.assertEqual([p for p, e, hashed in result if hashed], [paths[3]]);
+    self.assertEqual(result[3][1].root, ShaTree("changed").digest());
+
+  def test_persistent(self):
+    path = self.write("a", "A" * 100);
+    e = self.db.hash(path);
+    self.db.close();
+
+    self.db = HashDatabase(os.path.join(self.dir, "hashes.db"), ShaTree, 2);
+    self.assertEqual(self.db.lookup(path), e);
+
+  def test_stale(self):
+    path = self.write("a", "A" * 100);
+    self.db.hash(path);
+    self.write("a", "B" * 100, 2000);
+    self.assertEqual(self.db.lookup(path), None);
+    self.assertEqual(self.db.lookup_many([path]), {});
+
+  def test_prune(self):
+    paths = [self.write(str(i), str(i) * 50) for i in range(3)];
+    list(self.db.update(paths));
+    os.unlink(paths[0]);
+    self.write("1", "changed", 2000);
+    self.assertEqual(sorted(self.db.prune()), paths[:2]);
+    self.assertEqual(len(self.db), 1);
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import hashlib
+import random
+
+from adc import hashing
+from adc.hashing import *
+from adc.tth import TigerTree
+
+from tests.test_merkletree import ShaTree, SIZES
+
+class ShaBackend(TigerBackend):
+  """
+  Only implements digest, so the generic batched methods are used.
+  """
+  name = "sha";
+
+  def digest(self, *chunks):
+    return hashlib.sha256(''.join(chunks)).digest()[:24];
+
+class FakeMHASH(object):
+  """
+  Stands in for mhash.MHASH, with words in the opposite byte order like mhash.
+  """
+  def __init__(self, algo=None, h=None):
+    self.h = h or hashlib.sha256();
+
+  def update(self, data):
+    self.h.update(data);
+
+  def copy(self):
+    return FakeMHASH(h=self.h.copy());
+
+  def digest(self):
+    return ''.join(w[::-1] for w in (self.h.digest()[i:i+8] for i in range(0, 24, 8)));
+
+def fakeMhashTiger():
+  backend = MhashTiger.__new__(MhashTiger);
+  backend._new = FakeMHASH;
+  backend._leaf = FakeMHASH();
+  backend._leaf.update("\x00");
+  backend._node = FakeMHASH();
+  backend._node.update("\x01");
+  return backend;
+
+class ShaTigerTree(TigerTree):
+  segment = ShaTree.segment;
+  backend = "sha";
+
+class TestBackends(unittest.TestCase):
+  def setUp(self):
+    hashing.BACKENDS["sha"] = ShaBackend;
+
+  def tearDown(self):
+    del hashing.BACKENDS["sha"];
+
+  def test_batched(self):
+    backend = getBackend("sha");
+    data = "".join(chr(i % 256) for i in range(1000));
+    self.assertEqual(backend.leaves(data, 64), "".join(backend.digest("\x00", data[i:i+64]) for i in range(0, 1000, 64)));
+    self.assertEqual(backend.nodes(data[:24 * 5]), "".join(backend.digest("\x01", data[i:i+48]) for i in range(0, 96, 48)));
+    self.assertEqual(backend.leaves("", 64), "");
+
+  def test_same_tree(self):
+    for size in SIZES:
+      data = "A" * size;
+      self.assertEqual(ShaTigerTree(data).levels, ShaTree(data).levels);
+      hasher = ShaTigerTree.hasher();
+      hasher.update(data);
+      self.assertEqual(hasher.digest(), ShaTree(data).digest());
+
+  def test_shared_instance(self):
+    self.assertTrue(getBackend("sha") is getBackend("sha"));
+
+  def test_unknown(self):
+    self.assertRaises(ValueError, getBackend, "foo");
+
+  def test_mhash_byte_order(self):
+    swap = MhashTiger.__new__(MhashTiger)._swap;
+    rnd = random.Random(0);
+
+    for i in range(10):
+      d = "".join(chr(rnd.randint(0, 255)) for j in range(24));
+      self.assertEqual(swap(d), "".join(d[j*8:j*8+8][::-1] for j in range(3)));
+
+  def test_mhash_batched(self):
+    backend = fakeMhashTiger();
+    data = "".join(chr(i % 256) for i in range(1000));
+    self.assertEqual(backend.digest("\x00", "foo"), hashlib.sha256("\x00foo").digest()[:24]);
+    self.assertEqual(backend.leaves(data, 64), TigerBackend.leaves(backend, data, 64));
+    self.assertEqual(backend.nodes(data[:24 * 5]), TigerBackend.nodes(backend, data[:24 * 5]));
+
+class TestGcrypt(unittest.TestCase):
+  def setUp(self):
+    try:
+      self.backend = getBackend("gcrypt");
+    except ImportError:
+      self.skipTest("libgcrypt is not available");
+
+  def test_digest(self):
+    self.assertEqual(self.backend.digest("").encode("hex"), "3293ac630c13f0245f92bbb1766e16167a4e58492dde73f3");
+    self.assertEqual(self.backend.digest("\x00", ""), self.backend.digest("\x00"));
+
+  def test_batched(self):
+    backend = self.backend;
+
+    for size in [0, 1, 64, 1000, 1024]:
+      data = "".join(chr(i % 256) for i in range(size));
+      self.assertEqual(backend.leaves(data, 64), TigerBackend.leaves(backend, data, 64));
+      self.assertEqual(backend.nodes(data), TigerBackend.nodes(backend, data));
+
+if __name__ == "__main__":
+  unittest.main()
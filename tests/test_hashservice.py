@@ -0,0 +1,153 @@
+import unittest
+import tempfile
+import threading
+import Queue
+import time
+import os
+
+from twisted.internet import defer
+
+from adc.twisted.hashing import *
+from adc.twisted.hashing import HashService
+
+from tests.test_merkletree import ShaTree
+
+class FakeReactor(object):
+  """
+  Only what HashService needs, calls from threads are run by wait.
+  """
+  def __init__(self):
+    self.calls = Queue.Queue();
+
+  def callFromThread(self, f, *args, **kw):
+    self.calls.put((f, args, kw));
+
+  def addSystemEventTrigger(self, *args):
+    pass;
+
+  def wait(self, *deferreds):
+    results = list();
+
+    for d in deferreds:
+      d.addBoth(lambda r: results.append(r) or r);
+
+    while len(results) < len(deferreds):
+      f, args, kw = self.calls.get(timeout=10);
+      f(*args, **kw);
+
+class TestHashService(unittest.TestCase):
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp();
+    os.write(fd, "A" * 1000);
+    os.close(fd);
+    self.reactor = FakeReactor();
+    self.service = HashService(ShaTree, workers=1, maxqueue=3, reactor=self.reactor);
+
+  def tearDown(self):
+    self.service.stop();
+    os.unlink(self.path);
+
+  def result(self, d):
+    results = list();
+    d.addBoth(results.append);
+    return results[0];
+
+  def test_hashfile(self):
+    tree = ShaTree("A" * 1000);
+    d1 = self.service.hashfile(self.path);
+    d2 = self.service.tthl(self.path, blocksize=64);
+    self.reactor.wait(d1, d2);
+    self.assertEqual(self.result(d1), (tree.digest(), None));
+    self.assertEqual(self.result(d2), (tree.digest(), tree.tthl(blocksize=64)));
+
+  def blocker(self):
+    """
+    Occupy the only worker until the returned event is set.
+    """
+    event = threading.Event();
+    d = self.service.submit(lambda job: event.wait(10));
+    return event, d;
+
+  def test_priorities(self):
+    event, blocking = self.blocker();
+    order = list();
+
+    d1 = self.service.submit(lambda job: order.append("low"), priority=LOW);
+    d2 = self.service.submit(lambda job: order.append("high"), priority=HIGH);
+    d3 = self.service.submit(lambda job: order.append("normal"));
+
+    event.set();
+    self.reactor.wait(blocking, d1, d2, d3);
+    self.assertEqual(order, ["high", "normal", "low"]);
+
+  def test_cancel_pending(self):
+    event, blocking = self.blocker();
+    ran = list();
+
+    d = self.service.submit(lambda job: ran.append(job));
+    d.cancel();
+    self.assertTrue(self.result(d).check(defer.CancelledError));
+    self.assertEqual(self.service.pending, []);
+
+    event.set();
+    self.reactor.wait(blocking);
+    self.assertEqual(ran, []);
+
+  def test_cancel_running(self):
+    started = threading.Event();
+    event = threading.Event();
+
+    def job(job):
+      started.set();
+      event.wait(10);
+      return job.cancelled;
+
+    d = self.service.submit(job);
+    started.wait(10);
+    d.cancel();
+    self.assertTrue(self.result(d).check(defer.CancelledError));
+
+    after = self.service.submit(lambda job: "next");
+    event.set();
+    self.reactor.wait(after);
+    self.assertEqual(self.result(after), "next");
+
+  def test_stop_running(self):
+    started = threading.Event();
+
+    def job(job):
+      started.set();
+
+      while not job.cancelled:
+        time.sleep(0.01);
+
+    d = self.service.submit(job);
+    started.wait(10);
+
+    start = time.time();
+    self.service.stop();
+    self.assertTrue(time.time() - start < 5);
+    self.assertTrue(self.result(d).check(defer.CancelledError));
+
+  def test_stop_process(self):
+    service = HashService(ShaTree, workers=1, processes=True, reactor=self.reactor);
+    d = service.submit(service._inprocess, (time.sleep, (60,)));
+
+    while not service.running:
+      time.sleep(0.01);
+
+    time.sleep(0.2);
+    start = time.time();
+    service.stop();
+    self.assertTrue(time.time() - start < 5);
+    self.assertTrue(self.result(d).check(defer.CancelledError));
+
+  def test_queue_full(self):
+    event, blocking = self.blocker();
+    ds = [self.service.submit(lambda job: None) for i in range(3)];
+    self.assertTrue(self.result(self.service.submit(lambda job: None)).check(QueueFull));
+    event.set();
+    self.reactor.wait(blocking, *ds);
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import logging
+import zlib
+
+from twisted.test.proto_helpers import StringTransport
+
+from adc.arguments import *
+from adc.logger import Logger
+from adc.twisted.ctohprotocol import ADCHubProtocol, HubUser
+
+class TestHubProtocol(unittest.TestCase):
+    def setUp(self):
+        logger = Logger(ADCHubProtocol);
+        logger.setLogLevel(logging.CRITICAL);
+        
+        self.protocol = ADCHubProtocol(logger=logger);
+        self.transport = StringTransport();
+        self.protocol.makeConnection(self.transport);
+        
+        self.users = list();
+        self.protocol.connect("user-info", self.users.append);
+    
+    def test_user_info(self):
+        self.protocol.setState(self.protocol.context.NORMAL);
+        self.protocol.dataReceived("BINF AAAA NIfoo SS1024 I410.0.0.1 I6::ffff\n");
+        self.protocol.dataReceived("BINF AAAA I410.0.0.2\n");
+        
+        self.assertFalse(self.transport.disconnecting);
+        self.assertEqual(len(self.users), 2);
+        
+        user = self.users[-1];
+        self.assertEqual(user.sid, "AAAA");
+        self.assertEqual(user.ip4, IP("10.0.0.2"));
+        self.assertEqual(user.ip6, IP("::ffff", ipversion=6));
+
+    def test_compressed_after_sup(self):
+        self.protocol.connect("get-user", lambda: HubUser(NI="foo", SS=0));
+        
+        compressed = zlib.compress("ISID AAAA\n");
+        self.protocol.dataReceived("ISUP ADBASE ADTIGR ADZLIF\nIZON\n" + compressed + "BINF BBBB NIbar\n");
+        
+        self.assertFalse(self.transport.disconnecting);
+        self.assertEqual(self.protocol.hub.sid, "AAAA");
+        self.assertTrue("BINF AAAA " in self.transport.value());
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from adc.arguments import *
+from adc.twisted.helpers import LocalInfo
+
+class TestLocalInfo(unittest.TestCase):
+    def test_full_then_delta(self):
+        info = LocalInfo();
+        info.set('NI', "foo bar");
+        info.set('SS', 1024);
+        info.set('ID', Base32("FOOBAR"));
+        
+        self.assertEqual(info.full(), {'NI': "foo\\sbar", 'SS': "1024", 'ID': "IZHU6QSBKI"});
+        self.assertEqual(info.delta(), {});
+        
+        info.set('SS', 1024);
+        info.set('SL', 3);
+        self.assertEqual(info.delta(), {'SL': "3"});
+        
+        info.set('SS', 2048);
+        info.set('SS', 4096);
+        info.set('SL', None);
+        self.assertEqual(info.delta(), {'SS': "4096", 'SL': ""});
+    
+    def test_invalid_key(self):
+        self.assertRaises(ValueError, LocalInfo().set, 'XX', 1);
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+import logging
+import threading
+import time
+
+from StringIO import StringIO
+
+from adc.logger import *
+
+class Counted(object):
+  def __init__(self):
+    self.count = 0;
+
+  def __str__(self):
+    self.count += 1;
+    return "counted";
+
+class BlockingStream(object):
+  """
+  A stream whose writes wait for an event.
+  """
+  def __init__(self):
+    self.event = threading.Event();
+    self.data = StringIO();
+
+  def write(self, s):
+    self.event.wait(10);
+    self.data.write(s);
+
+  def flush(self):
+    pass;
+
+class FailingStream(object):
+  """
+  A stream whose first writes fail, like a closed pipe.
+  """
+  def __init__(self, failures):
+    self.failures = failures;
+    self.data = StringIO();
+
+  def write(self, s):
+    if self.failures > 0:
+      self.failures -= 1;
+      raise IOError(32, "Broken pipe");
+
+    self.data.write(s);
+
+  def flush(self):
+    pass;
+
+class TestLogger(unittest.TestCase):
+  def test_filtered_not_formatted(self):
+    log = Logger(TestLogger);
+    log.stream = StringIO();
+    log.setLogLevel(logging.INFO);
+
+    value = Counted();
+    log.msg("debug", value, logLevel=logging.DEBUG);
+    self.assertEqual(value.count, 0);
+    self.assertEqual(log.stream.getvalue(), "");
+    self.assertFalse(log.enabled(logging.DEBUG));
+
+    log.msg("info", value);
+    self.assertEqual(value.count, 1);
+    self.assertTrue(log.stream.getvalue().endswith("[TestLogger] [] info counted\n"));
+
+  def test_timestamp(self):
+    now = time.time();
+    self.assertEqual(timestamp(now), time.strftime("%Y-%m-%d %H:%M:%S%z", time.localtime(now)));
+    self.assertTrue(timestamp(now) is timestamp(now + 0.0001) or int(now) != int(now + 0.0001));
+
+  def test_async_sink(self):
+    stream = StringIO();
+    sink = AsyncSink(stream);
+    log = Logger(TestLogger, "a", "b", sink=sink);
+
+    for i in range(100):
+      log.msg("line", i);
+
+    sink.close();
+    lines = stream.getvalue().splitlines();
+    self.assertEqual(len(lines), 100);
+    self.assertTrue(lines[-1].endswith("[TestLogger] [a b] line 99"));
+    self.assertEqual(sink.dropped, 0);
+    self.assertEqual(sink.written, 100);
+
+  def test_async_sink_drops(self):
+    stream = BlockingStream();
+    sink = AsyncSink(stream, maxsize=5, batch=1);
+    log = Logger(TestLogger, sink=sink);
+
+    for i in range(20):
+      log.msg("line", i);
+
+    self.assertTrue(sink.dropped >= 14);
+    stream.event.set();
+    sink.close();
+
+    output = stream.data.getvalue();
+    self.assertTrue("dropped " + str(sink.dropped) + " log records" in output, output);
+
+  def test_async_sink_write_error(self):
+    stream = FailingStream(1);
+    sink = AsyncSink(stream, batch=1);
+    log = Logger(TestLogger, sink=sink);
+
+    log.msg("lost");
+    sink.flush();
+    self.assertTrue(sink.thread.is_alive());
+    self.assertEqual(sink.errors, 1);
+
+    log.msg("written");
+    sink.close();
+    self.assertTrue(stream.data.getvalue().endswith("written\n"));
+
+  def test_non_ascii(self):
+    log = Logger(TestLogger, "n\xc3\xa4me");
+    log.stream = StringIO();
+    log.msg("line", "n\xc3\xa4me", u"n\xe4me");
+    self.assertTrue(log.stream.getvalue().endswith("[n\xc3\xa4me] line n\xc3\xa4me n\xc3\xa4me\n"));
+
+  def test_async_sink_format_error(self):
+    class Broken(object):
+      def __str__(self):
+        raise ValueError("broken");
+
+    stream = StringIO();
+    sink = AsyncSink(stream);
+    sink.close();
+
+    records = [(time.time(), logging.INFO, "Test", (), (m,)) for m in ["one", "n\xc3\xa4me", Broken(), "three"]];
+    sink.write(records);
+    self.assertEqual([l.split(" ")[-1] for l in stream.getvalue().splitlines()], ["one", "n\xc3\xa4me", "three"]);
+    self.assertEqual(sink.errors, 1);
+    self.assertEqual(sink.written, 3);
+
+  def test_async_sink_close_full(self):
+    stream = BlockingStream();
+    sink = AsyncSink(stream, maxsize=2, batch=1);
+    log = Logger(TestLogger, sink=sink);
+
+    for i in range(5):
+      log.msg("line", i);
+
+    start = time.time();
+    sink.close(0.1);
+    self.assertTrue(time.time() - start < 5);
+
+    stream.event.set();
+    sink.thread.join(10);
+    self.assertFalse(sink.thread.is_alive());
+
+if __name__ == "__main__":
+  unittest.main()
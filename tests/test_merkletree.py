@@ -0,0 +1,251 @@
+import unittest
+import hashlib
+import random
+import tempfile
+import os
+
+from adc.merkletree import MerkleTree, MerkleHasher, split_ranges
+
+class ShaTree(MerkleTree):
+  """
+  A tree over a hash available everywhere, with small segments to get deep trees cheaply.
+  """
+  segment = 8;
+  hashsize = 24;
+
+  @staticmethod
+  def _hash(*chunks):
+    return hashlib.sha256(''.join(chunks)).digest()[:24];
+
+def tree_levels(tree):
+  """
+  Hashes per level, leaves first.
+  """
+  hs = tree.hashsize;
+  return [[level[i:i+hs] for i in range(0, len(level), hs)] for level in tree.levels];
+
+def node_serialize(root):
+  """
+  Breadth first serialization of linked nodes.
+  """
+  result = [];
+  queue = [root];
+
+  while queue:
+    n = queue.pop(0);
+    result.append(n.hash);
+    queue.extend(c for c in (n.left, n.right) if c is not None);
+
+  return ''.join(result);
+
+SIZES = [0, 1, 7, 8, 9, 16, 17, 24, 31, 32, 33, 63, 64, 65, 100, 255, 256, 257, 1000];
+
+class TestMerkleHasher(unittest.TestCase):
+  sizes = SIZES;
+
+  def test_same_root(self):
+    rnd = random.Random(0);
+
+    for size in self.sizes:
+      data = ''.join(chr(rnd.randint(0, 255)) for i in range(size));
+      hasher = ShaTree.hasher();
+
+      i = 0;
+      while i < size:
+        n = rnd.randint(1, 20);
+        hasher.update(data[i:i+n]);
+        i += n;
+
+      self.assertEqual(hasher.digest(), ShaTree(data).digest(), size);
+      self.assertEqual(hasher.base32(), ShaTree(data).base32(), size);
+
+  def test_digest_is_not_final(self):
+    hasher = ShaTree.hasher();
+    hasher.update("A" * 20);
+    hasher.digest();
+    hasher.update("A" * 20);
+    self.assertEqual(hasher.digest(), ShaTree("A" * 40).digest());
+
+  def test_levels(self):
+    for size in self.sizes:
+      data = "A" * size;
+      levels = tree_levels(ShaTree(data));
+
+      for level in range(8):
+        hasher = ShaTree.hasher(level);
+        hasher.update(data);
+
+        if level < len(levels):
+          expected = levels[level];
+        else:
+          expected = levels[-1];
+
+        self.assertEqual(hasher.levelhashes(), expected, (size, level));
+
+class TestFlatTree(unittest.TestCase):
+  def test_serialize(self):
+    for size in SIZES:
+      tree = ShaTree("A" * size);
+      data = tree.serialize();
+      self.assertEqual(data, node_serialize(tree.root));
+      self.assertEqual(ShaTree.deserialize(data), tree);
+      self.assertEqual(ShaTree.deserialize(data, len(tree.levels)), tree);
+
+  def test_nodes(self):
+    for size in SIZES:
+      tree = ShaTree("B" * size);
+      self.assertEqual(ShaTree(tree.root), tree);
+      self.assertEqual(tree.root.hash, tree.digest());
+
+  def test_level_sizes(self):
+    tree = ShaTree("A" * (17 * ShaTree.segment));
+    self.assertEqual([len(l) // ShaTree.hashsize for l in tree.levels], [17, 9, 5, 3, 2, 1]);
+
+  def test_not_equal(self):
+    self.assertNotEqual(ShaTree("A" * 100), ShaTree("B" * 100));
+    self.assertNotEqual(ShaTree("A" * 100), ShaTree("A" * 101));
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, ShaTree.deserialize, "");
+    self.assertRaises(ValueError, ShaTree.deserialize, "A" * 25);
+    # 1, 3 and 6 hashes are trees with 1, 2 and 3 leaves.
+    self.assertRaises(ValueError, ShaTree.deserialize, "A" * 24 * 4);
+    self.assertRaises(ValueError, ShaTree.deserialize, "A" * 24 * 6, 2);
+
+class FileTestCase(unittest.TestCase):
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp();
+    os.close(fd);
+
+  def tearDown(self):
+    os.unlink(self.path);
+
+  def write(self, data):
+    with open(self.path, "wb") as fp:
+      fp.write(data);
+
+class TestFiles(FileTestCase):
+  def test_from_path(self):
+    for size in SIZES:
+      data = "C" * size;
+      self.write(data);
+
+      for mmapsize in [1, 64, 1 << 20]:
+        self.assertEqual(ShaTree.from_path(self.path, mmapsize), ShaTree(data), (size, mmapsize));
+
+  def test_file(self):
+    for size in SIZES:
+      data = "D" * size;
+      self.write(data);
+
+      with open(self.path, "rb") as fp:
+        self.assertEqual(ShaTree(fp), ShaTree(data), size);
+
+class TestLevels(FileTestCase):
+  def test_depth(self):
+    for size in SIZES:
+      self.assertEqual(ShaTree.depth(size), len(ShaTree("A" * size).levels), size);
+
+  def test_tthl(self):
+    tree = ShaTree("A" * (17 * ShaTree.segment));
+    self.assertEqual(tree.tthl(blocksize=8), tree.levels[0]);
+    self.assertEqual(tree.tthl(blocksize=32), tree.levels[2]);
+    self.assertEqual(tree.tthl(blocksize=1 << 20), tree.digest());
+    self.assertEqual(tree.tthl(levels=1), tree.digest());
+    self.assertEqual(tree.tthl(levels=3), tree.levels[3]);
+    self.assertEqual(tree.tthl(levels=100), tree.levels[0]);
+
+  def test_invalid(self):
+    tree = ShaTree("A" * 100);
+    self.assertRaises(ValueError, tree.tthl);
+    self.assertRaises(ValueError, tree.tthl, 8, 1);
+    self.assertRaises(ValueError, tree.tthl, 24);
+    self.assertRaises(ValueError, tree.tthl, None, 0);
+
+  def test_stream(self):
+    for size in SIZES:
+      data = "E" * size;
+      tree = ShaTree(data);
+      self.write(data);
+
+      for kw in [{"blocksize": 8}, {"blocksize": 64}, {"levels": 1}, {"levels": 3}]:
+        with open(self.path, "rb") as fp:
+          self.assertEqual(ShaTree.streamtthl(fp, **kw), (tree.digest(), tree.tthl(**kw)), (size, kw));
+
+class TestVerifier(unittest.TestCase):
+  def verifier(self, data, blocksize, size=None):
+    tree = ShaTree(data);
+    return ShaTree.verifier(tree.digest(), tree.tthl(blocksize), blocksize, size);
+
+  def test_blocks(self):
+    data = ''.join(chr(i % 256) for i in range(300));
+    verifier = self.verifier(data, 32, 300);
+    self.assertEqual(verifier.blocks, 10);
+
+    self.assertEqual(verifier.verify(64, data[64:128]), ([2, 3], []));
+    self.assertEqual(verifier.verify(288, data[288:]), ([9], []));
+
+    corrupt = data[:40] + "X" + data[41:100];
+    self.assertEqual(verifier.verify(0, corrupt[:96]), ([0, 2], [1]));
+    self.assertEqual(verifier.missing(), [1, 4, 5, 6, 7, 8]);
+    self.assertFalse(verifier.complete());
+
+    verifier.verify(0, data);
+    self.assertEqual(verifier.bad, set());
+    self.assertTrue(verifier.complete());
+
+  def test_buffers(self):
+    import mmap;
+
+    data = ''.join(chr(i % 256) for i in range(300));
+    mm = mmap.mmap(-1, len(data));
+    mm.write(data);
+
+    for buf in [bytearray(data), buffer(data), memoryview(data), memoryview(bytearray(data)), mm]:
+      verifier = self.verifier(data, 32, 300);
+      self.assertEqual(verifier.verify(0, buf), (range(10), []), type(buf));
+
+    mm.close();
+
+  def test_sizes(self):
+    for size in SIZES:
+      data = "F" * size;
+
+      for blocksize in [8, 32, 1024]:
+        verifier = self.verifier(data, blocksize, size);
+        verifier.verify(0, data);
+        self.assertTrue(verifier.complete(), (size, blocksize));
+
+  def test_unaligned(self):
+    data = "G" * 300;
+    verifier = self.verifier(data, 32, 300);
+    self.assertRaises(ValueError, verifier.verify, 16, data[16:48]);
+    self.assertRaises(ValueError, verifier.verify, 0, data[:48]);
+    self.assertRaises(ValueError, verifier.verify, 256, data[256:290]);
+    self.assertRaises(ValueError, verifier.verify, 320, "G");
+    self.assertRaises(ValueError, verifier.verify, 32, "");
+
+  def test_invalid_hashes(self):
+    tree = ShaTree("H" * 300);
+    self.assertRaises(ValueError, ShaTree.verifier, tree.digest(), tree.tthl(32)[:-24], 32);
+    self.assertRaises(ValueError, ShaTree.verifier, tree.digest(), tree.tthl(32), 32, 400);
+    self.assertRaises(ValueError, ShaTree.verifier, tree.digest(), tree.tthl(32), 24);
+
+class TestParallel(FileTestCase):
+  def test_split_ranges(self):
+    self.assertEqual(split_ranges(ShaTree, 0, 4, 1), [(0, 0)]);
+    self.assertEqual(split_ranges(ShaTree, 100, 2, 1), [(0, 16), (16, 16), (32, 16), (48, 16), (64, 16), (80, 16), (96, 4)]);
+    self.assertEqual(split_ranges(ShaTree, 100, 2, 40), [(0, 64), (64, 36)]);
+
+  def test_same_root(self):
+    rnd = random.Random(0);
+
+    for size in SIZES:
+      data = ''.join(chr(rnd.randint(0, 255)) for i in range(size));
+      self.write(data);
+
+      for workers in [1, 3]:
+        self.assertEqual(ShaTree.parallel(self.path, workers, 8), ShaTree(data).digest(), (size, workers));
+
+if __name__ == "__main__":
+  unittest.main()
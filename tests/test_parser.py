@@ -3,17 +3,18 @@ from adc.parser import *
 from adc.message import *
 
 import adc.parser as parser
+import adc.benchmark as benchmark
 
 import unittest
 
 class TestParser(unittest.TestCase):
     def test_command_name(self):
         for s in ["AAA", "Z99", "A00", "ZAA"]:
-            self.assertEqual(parser.command_name.parseString(s, parseAll=True)["command_name"], s)
+            self.assertEqual(parser.getGrammar().command_name.parseString(s, parseAll=True)["command_name"], s)
     
     def test_feature_name(self):
         for s in ["AAAA", "Z999", "A000", "ZAAA"]:
-            self.assertEqual(parser.feature_name.parseString(s, parseAll=True)[0], s)
+            self.assertEqual(parser.getGrammar().feature_name.parseString(s, parseAll=True)[0], s)
     
     def test_features_list(self):
         test_s = list();
@@ -24,7 +25,7 @@ class TestParser(unittest.TestCase):
         
         for s in test_s:
             i = 0;
-            for f in parser.feature_list.parseString(s[0], parseAll=True)["feature_list"][:]:
+            for f in parser.getGrammar().feature_list.parseString(s[0], parseAll=True)["feature_list"][:]:
                 self.assertEqual(f[:], s[1][i])
                 i += 1;
     
@@ -67,6 +68,92 @@ class TestParser(unittest.TestCase):
         self.assertTrue(isinstance(message.header, UDP));
         self.assertEqual(message.header.my_cid, "AAAA");
 
+class TestFastParser(unittest.TestCase):
+    frames = [
+        "",
+        "BART AAAA",
+        "BART AAAA TEfoo\\sbar\\nbaz\\\\ +x \\x\\",
+        "CINF IDAAAA NIfoo",
+        "IART",
+        "HART",
+        "DART AAAA BBBB",
+        "EART AAAA BBBB foo",
+        "FART AAAA +T000 -T002 +abc x",
+        "UART AAAA7 foo",
+    ];
+
+    invalid = [
+        "CINFX", "CINF ", "CINF  a", "BART AAAAA", "BART AAA", "bART", "GART",
+        "FART AAAA", "FART AAAA x", "FART AAAA +T0001", "UART A1", "CINF x\ny",
+    ];
+
+    def test_same_messages(self):
+        for s in self.frames:
+            self.assertEqual(benchmark.canonical(Message.parse(s, "fast")), benchmark.canonical(Message.parse(s, "pyparsing")), s);
+
+    def test_invalid(self):
+        for s in self.invalid:
+            self.assertRaises(Exception, Message.parse, s, "pyparsing");
+            self.assertRaises(ValueError, Message.parse, s, "fast");
+
+    def test_corpus_conformance(self):
+        for family in benchmark.FAMILIES:
+            self.assertEqual(benchmark.conformance(benchmark.generate(family, 6)), []);
+
+    def test_lazy_message(self):
+        message = LazyMessage.parse("BMSG AAAA foo\\sbar NIbaz");
+        self.assertTrue(isinstance(message.header, Broadcast));
+        self.assertEqual(message.header.my_sid, "AAAA");
+        self.assertEqual(message._params, None);
+        self.assertEqual(message.getfirst("NI"), "baz");
+        self.assertEqual(message.params, ("foo bar", "NIbaz"));
+
+    def test_lazy_invalid_parameters(self):
+        message = LazyMessage.parse("BMSG AAAA foo ");
+        self.assertEqual(message.header.cmd, "MSG");
+        self.assertRaises(ValueError, message.get, "NI");
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, getParser, "foo");
+
+class TestMessageIndex(unittest.TestCase):
+    def test_named_parameters(self):
+        for parse in [Message.parse, LazyMessage.parse]:
+            message = parse("BINF AAAA NIfoo ADBASE ADTIGR HN SS10");
+            self.assertEqual(message.get("AD"), ["BASE", "TIGR"]);
+            self.assertEqual(message.get("HN"), [""]);
+            self.assertEqual(message.get("XX"), []);
+            self.assertEqual(message.getfirst("SS"), "10");
+            self.assertEqual(message.getfirst("XX"), None);
+            self.assertEqual(message.getkeys(), ["NI", "AD", "AD", "SS"]);
+            self.assertTrue(message.haskey("AD"));
+            self.assertFalse(message.haskey("HN"));
+            self.assertEqual(message.get("A"), ["DBASE", "DTIGR"]);
+    
+    def test_reindex_on_assignment(self):
+        message = Message(Broadcast(my_sid="AAAA", cmd='INF'), NI="foo");
+        self.assertEqual(message.getfirst("NI"), "foo");
+        message.params = ["NIbar"];
+        self.assertEqual(message.getfirst("NI"), "bar");
+
+class TestHeaders(unittest.TestCase):
+    def test_slots(self):
+        message = Message.parse("DART AAAA BBBB foo", "fast");
+        self.assertFalse(hasattr(message, "__dict__"));
+        self.assertFalse(hasattr(message.header, "__dict__"));
+
+    def test_trusted_construction(self):
+        frames = [
+            ("BART AAAA", Broadcast), ("CART", Client), ("IART", Info), ("HART", Hub),
+            ("DART AAAA BBBB", Direct), ("EART AAAA BBBB", Echo),
+            ("FART AAAA +T000 -T002", Feature), ("UART AAAA", UDP),
+        ];
+        
+        for s, klass in frames:
+            header = Message.parse(s, "fast").header;
+            self.assertEqual(str(header), s);
+            self.assertEqual(header.__class__, klass);
+
 class TestMessages(unittest.TestCase):
     def test_b_message(self):
         self.assertEqual(str(Message(Broadcast(my_sid="AAAA", cmd='ART'))), "BART AAAA")
@@ -80,5 +167,63 @@ class TestMessages(unittest.TestCase):
         self.assertEqual(str(Message(Client(cmd='INF'), I4=encode(IP('10.0.0.1', ipversion=4)), I6=encode(IP('::ffff', ipversion=6)), ID=encode(Base32('FOOBARBAZ')), PD=encode(Base32('FOOBAR')))), 
             "CINF I6::ffff I410.0.0.1 PDIZHU6QSBKI IDIZHU6QSBKJBECWQ")
 
+    def test_encode_cache(self):
+        message = Message(Broadcast(my_sid="AAAA", cmd='MSG'), "foo");
+        self.assertEqual(message.encode(), "BMSG AAAA foo");
+        self.assertTrue(message.encode() is message.encode());
+        message.params = ["bar"];
+        self.assertEqual(str(message), "BMSG AAAA bar");
+        message.header = Broadcast(my_sid="BBBB", cmd='MSG');
+        self.assertEqual(str(message), "BMSG BBBB bar");
+        message.header.my_sid = "CCCC";
+        self.assertEqual(str(message), "BMSG CCCC bar");
+        message.header.cmd = "SCH";
+        self.assertEqual(str(message), "BSCH CCCC bar");
+        self.assertTrue(isinstance(message.params, tuple));
+    
+    def test_encode_cache_feature(self):
+        message = Message(Feature(my_sid="AAAA", cmd='SCH', add=["TCP4"]), "foo");
+        self.assertEqual(str(message), "FSCH AAAA +TCP4 foo");
+        message.header.add.append("UDP4");
+        self.assertEqual(str(message), "FSCH AAAA +TCP4 +UDP4 foo");
+
+class TestArguments(unittest.TestCase):
+    def test_ip(self):
+        self.assertEqual(decode("10.0.0.1", IP4), IP("10.0.0.1", ipversion=4));
+        self.assertEqual(int(decode("10.0.0.1", IP4)), 0x0a000001);
+        self.assertEqual(encode(decode("::ffff", IP6)), "::ffff");
+        self.assertRaises(ValueError, decode, "10.0.0", IP4);
+        self.assertEqual(decode(IP("10.0.0.1"), IP4), IP("10.0.0.1"));
+        self.assertEqual(decode(decode("::ffff", IP6), IP6), IP("::ffff", ipversion=6));
+    
+    def test_base32(self):
+        self.assertEqual(decode(encode(Base32("FOOBARBAZ")), B32, 9).val, "FOOBARBAZ");
+        self.assertEqual(decode(encode(Base32("FOOBAR")), B32, 6).val, "FOOBAR");
+    
+    def test_escape_roundtrip(self):
+        s = "foo bar\nbaz\\sx";
+        self.assertEqual(Message.parse("BMSG AAAA " + encode(s), "fast").params, (s,));
+        self.assertEqual(Message.parse("BMSG AAAA " + encode(s), "pyparsing").params, (s,));
+    
+    def test_unknown(self):
+        self.assertRaises(ValueError, encode, object());
+        self.assertRaises(ValueError, decode, "foo", "FOO");
+
+class TestTemplates(unittest.TestCase):
+    def test_same_as_message(self):
+        template = Template(Broadcast, 'MSG', None, 'PM');
+        self.assertEqual(template.format("AAAA", "foo bar\nbaz", "BBBB"), str(Message(Broadcast(my_sid="AAAA", cmd='MSG'), encode("foo bar\nbaz"), PM="BBBB")));
+        self.assertEqual(template.format("AAAA", "foo", None), "BMSG AAAA foo");
+    
+    def test_fixed_parameters(self):
+        template = Template(Client, 'INF', 'SS', 'SL', ID=Base32("FOOBAR"));
+        self.assertEqual(template.format(1024, None), "CINF SS1024 IDIZHU6QSBKI");
+        self.assertRaises(ValueError, template.format, 1024);
+    
+    def test_invalid(self):
+        self.assertRaises(ValueError, Template, Feature, 'SCH');
+        self.assertRaises(ValueError, Template, Broadcast, 'msg');
+        self.assertRaises(ValueError, Template, Broadcast, 'MSG', 'TOO');
+
 if __name__ == "__main__":
     unittest.main()
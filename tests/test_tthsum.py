@@ -0,0 +1,80 @@
+import unittest
+import tempfile
+import shutil
+import base64
+import os
+
+from StringIO import StringIO
+
+from adc.tth import tthsum
+from adc.hashdb import HashDatabase
+
+from tests.test_merkletree import ShaTree
+
+class TestTTHSum(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp();
+    self.files = dict();
+
+    for name in ["b", "a/y", "a/x", "a/c/z", "c"]:
+      self.write(name, name * 100);
+
+  def tearDown(self):
+    shutil.rmtree(self.dir);
+
+  def write(self, name, data):
+    path = os.path.join(self.dir, name);
+
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path));
+
+    with open(path, "wb") as fp:
+      fp.write(data);
+
+    self.files[path] = data;
+    return path;
+
+  def expected(self, names):
+    lines = list();
+
+    for name in names:
+      path = os.path.join(self.dir, name);
+      lines.append(base64.b32encode(ShaTree(self.files[path]).digest()).rstrip("=") + "  " + path + "\n");
+
+    return ''.join(lines);
+
+  def run_tthsum(self, paths, **kw):
+    out = StringIO();
+    err = StringIO();
+    failed = tthsum(paths, ShaTree, out=out, err=err, **kw);
+    return failed, out.getvalue(), err.getvalue();
+
+  def test_walk_order(self):
+    for jobs in [1, 3]:
+      failed, out, err = self.run_tthsum([self.dir], jobs=jobs);
+      self.assertEqual(failed, 0);
+      self.assertEqual(out, self.expected(["b", "c", "a/x", "a/y", "a/c/z"]));
+      self.assertTrue("5 files (5 hashed, 0 cached, 0 failed)" in err, err);
+
+  def test_files(self):
+    failed, out, err = self.run_tthsum([os.path.join(self.dir, "c"), os.path.join(self.dir, "a/x"), os.path.join(self.dir, "missing")], jobs=1);
+    self.assertEqual(failed, 1);
+    self.assertEqual(out, self.expected(["c", "a/x"]));
+
+  def test_cache(self):
+    cache = os.path.join(tempfile.mkdtemp(), "hashes.db");
+
+    try:
+      failed, first, err = self.run_tthsum([self.dir], jobs=2, cache=cache);
+      failed, second, err = self.run_tthsum([self.dir], jobs=2, cache=cache);
+      self.assertEqual(first, second);
+      self.assertTrue("5 files (0 hashed, 5 cached, 0 failed)" in err, err);
+
+      db = HashDatabase(cache, ShaTree);
+      self.assertEqual(len(db), 5);
+      db.close();
+    finally:
+      shutil.rmtree(os.path.dirname(cache));
+
+if __name__ == "__main__":
+  unittest.main()